@@ -1,9 +1,12 @@
+import array
 import ast
 import copy
 import csv
+import json
 import os
 import re
 import statistics
+import struct
 import sys
 import matplotlib.pyplot as plt
 import matplotlib.backends.backend_pdf
@@ -14,6 +17,9 @@ def derive_datatype(datastr):
     except:
         return type("")
 
+def ns_to_sec(ns):
+    return ns / 1000000000.0
+
 def system_conf_fullname(system_conf):
     l = [
         'turbo={}'.format(system_conf['turbo']),
@@ -44,34 +50,30 @@ def system_conf_shortname(system_conf):
 def shortname(qps=None):
     return 'qps={}'.format(qps)
 
-def parse_rapl_stats(rapl_stats_file):
+def rapl_avg_power(series):
+    # energy_uj samples are unwrapped by the profiler, so the first and last samples 
+    # give the energy consumed over the whole run
+    (ts_start, energy_start) = series[0]
+    (ts_end, energy_end) = series[-1]
+    return (energy_end - energy_start)/(ns_to_sec(ts_end - ts_start))/1000000
+
+def parse_rapl_stats(metrics):
     stats = {}
-    counter=0
     stats['package-0'] = []
     stats['package-1'] = []
     stats['dram'] = []
-    package_0=0
-    package_1=0
-    dram=0
    
-    package_0_stats_file = os.path.join(rapl_stats_file,'package-0')
-    
-    with open(package_0_stats_file, 'r') as f:
-        metric,series = read_timeseries(package_0_stats_file)
-        package_0=(series[1][1] - series[0][1])/((series[1][0]-series[0][0]))/1000000
-        stats['package-0'].append(float(package_0))
+    stats['package-0'].append(float(rapl_avg_power(metrics['package-0'])))
     
-    package_1_stats_file = os.path.join(rapl_stats_file,'package-1')
-    with open(package_1_stats_file, 'r') as f:
-        metric,series = read_timeseries(package_1_stats_file)
-        package_1=(series[1][1] - series[0][1])/((series[1][0]-series[0][0]))/1000000
-        stats['package-1'].append(float(package_1))
+    stats['package-1'].append(float(rapl_avg_power(metrics['package-1'])))
     
-    dram_stats_file = os.path.join(rapl_stats_file,'dram')
-    with open(dram_stats_file, 'r') as f:
-        metric,series = read_timeseries(dram_stats_file)
-        dram=(series[1][1] - series[0][1])/((series[1][0]-series[0][0]))/1000000
-        stats['dram'].append(float(dram))
+    # dram is a sub-zone of each package 
+    dram = 0
+    for (metric_name, series) in metrics.items():
+        if re.match('package-[0-9]+/dram$', metric_name):
+            dram += rapl_avg_power(series)
+    stats['dram'].append(float(dram))
+    return stats
 
 def parse_mcperf_stats(mcperf_results_path):
     stats = None
@@ -94,6 +96,7 @@ def parse_mcperf_stats(mcperf_results_path):
     return stats
 
 def read_timeseries(filepath):
+    """Reads a metric file whose lines are nanosecond timestamp,value pairs"""
     header = None
     timeseries = None
     with open(filepath, 'r') as f:
@@ -109,6 +112,50 @@ def read_timeseries(filepath):
             timeseries.append((timestamp, value))
     return (header, timeseries)            
 
+packed_report_file_name = 'report.bin'
+# describes where the profiler ran rather than holding a metric
+placement_file_name = 'placement.json'
+
+def read_packed_report(filepath):
+    """Reads a report written by profiler.py report --format packed.
+
+    Returns a dict mapping every metric name to its list of nanosecond 
+    timestamp,value pairs. The file is loaded with a single read.
+    """
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    if not data.startswith(b'MCPROF1\n'):
+        raise Exception('{} is not a packed report'.format(filepath))
+    (index_len,) = struct.unpack_from('<Q', data, 8)
+    index = json.loads(data[16:16+index_len].decode('utf-8'))
+    columns = memoryview(data)[16+index_len:]
+    metrics = {}
+    for m in index['metrics']:
+        timestamps = array.array(index['timestamp_typecode'])
+        values = array.array(index['value_typecode'])
+        timestamps_end = m['offset'] + m['count'] * timestamps.itemsize
+        values_end = timestamps_end + m['count'] * values.itemsize
+        timestamps.frombytes(columns[m['offset']:timestamps_end])
+        values.frombytes(columns[timestamps_end:values_end])
+        if index['byteorder'] != sys.byteorder:
+            timestamps.byteswap()
+            values.byteswap()
+        metrics[m['name']] = list(zip(timestamps, values))
+    return metrics
+
+def read_stats_dir(stats_dir):
+    """Reads the metrics of a profiler report directory, either packed or one file per metric"""
+    packed_report = os.path.join(stats_dir, packed_report_file_name)
+    if os.path.exists(packed_report):
+        return read_packed_report(packed_report)
+    metrics = {}
+    for f in os.listdir(stats_dir):
+        if f.endswith('.tmp') or f == placement_file_name:
+            continue
+        (metric_name, timeseries) = read_timeseries(os.path.join(stats_dir, f))
+        metrics[metric_name] = timeseries
+    return metrics
+
 def add_metric_to_dict(stats_dict, metric_name, metric_value):
     head = metric_name.split('.')[0]
     tail = metric_name.split('.')[1:]
@@ -118,38 +165,31 @@ def add_metric_to_dict(stats_dict, metric_name, metric_value):
     else:
         stats_dict[head] = metric_value
 
-def parse_cstate_stats(stats_dir):
+def parse_cstate_stats(metrics):
     stats = {}
     prog = re.compile('(.*)\.(.*)\.(.*)')
-    for f in os.listdir(stats_dir):
-        m = prog.match(f)
+    for (metric_name, timeseries) in metrics.items():
+        m = prog.match(metric_name)
         if m:
-            stats_file = os.path.join(stats_dir, f)
-            cpu_id = m.group(1)
-            state_name = m.group(2)
-            metric_name = m.group(3)
-            (metric_name, timeseries) = read_timeseries(stats_file)
             add_metric_to_dict(stats, metric_name, timeseries)
     return stats
 
-def parse_perf_stats(stats_dir):
+def parse_perf_stats(metrics):
     stats = {}
     prog = re.compile('(.*)\.(.*)\.(.*)')
-    for f in os.listdir(stats_dir):
-        m = prog.match(f)
+    for (metric_name, timeseries) in metrics.items():
+        m = prog.match(metric_name)
         if not m:
-            stats_file = os.path.join(stats_dir, f)
-            (metric_name, timeseries) = read_timeseries(stats_file)
             add_metric_to_dict(stats, metric_name, timeseries)
     return stats
 
 def parse_single_instance_stats(stats_dir):
     stats = {}
-    rapl_stats_file = os.path.join(stats_dir,'memcached')
-    server_rapl_stats = parse_rapl_stats(rapl_stats_file)
     server_stats_dir = os.path.join(stats_dir, 'memcached')
-    server_cstate_stats = parse_cstate_stats(server_stats_dir)
-    server_perf_stats = parse_perf_stats(server_stats_dir)
+    server_metrics = read_stats_dir(server_stats_dir)
+    server_rapl_stats = parse_rapl_stats(server_metrics)
+    server_cstate_stats = parse_cstate_stats(server_metrics)
+    server_perf_stats = parse_perf_stats(server_metrics)
     stats['server'] = {**server_rapl_stats, **server_cstate_stats, **server_perf_stats}
     mcperf_stats_file = os.path.join(stats_dir, 'mcperf')
     stats['mcperf'] = parse_mcperf_stats(mcperf_stats_file)
@@ -174,11 +214,11 @@ def cpu_state_time_perc(data, cpu_id):
         if state_name in data[cpu_str]:
             (ts_start, val_start) = data[cpu_str][state_name]['time'][0]
             (ts_end, val_end) = data[cpu_str][state_name]['time'][-1]
-            time_us = max(time_us, (ts_end - ts_start) * 1000000.0)
+            time_us = max(time_us, (ts_end - ts_start) / 1000.0)
             total_state_time += val_end - val_start    
-    time_us = max(time_us, total_state_time)
-    # FIXME: time duration is currently hardcoded at 120s (120000000us)
-    extra_c6_time_us = time_us - 120000000
+    # residency that the counters accumulated beyond the measured window is 
+    # attributed to the deepest state, which is the one that spans sample boundaries
+    extra_c6_time_us = max(0, total_state_time - time_us)
     # calculate percentage
     for state_name in state_names:
         if state_name == 'C6':
@@ -436,7 +476,7 @@ def avg_power(timeseries):
     total_val = 0
     for (ts, val) in timeseries:
         total_val += val
-    time = timeseries[-1][0] - timeseries[0][0]
+    time = ns_to_sec(timeseries[-1][0] - timeseries[0][0])
     return total_val / time
 
 def get_power_per_target_qps(stats, system_confs, qps_list):
@@ -4,6 +4,7 @@
 ###########################
 
 import csv
+import os
 import sys
 import itertools
 
@@ -62,6 +63,38 @@ def collect_intervals(intervals_file,num_cores):
         
     return(all_intervals)
 
+#The profiler's idle trace holds, for every core, a timeseries idletrace.cpuN.state with 
+#the idle state entered at each transition, or -1 when the core left idle. As with CC0 
+#in SoCWatch traces, state 0 (POLL) counts as busy. A core without transitions, such as
+#a polling worker or a core outside the traced cpus, was busy the whole run, and a core 
+#whose first transition is an exit was idle from the start of the trace.
+
+def collect_trace_intervals(metrics,num_cores):
+
+    series = [metrics.get('idletrace.cpu{}.state'.format(core), []) for core in range(0,num_cores)]
+    if not any(series):
+        raise Exception('The report holds no idle trace')
+    start = min([s[0][0] for s in series if s])
+    end = max([s[-1][0] for s in series if s])
+    all_intervals = {}
+    for core in range(0,num_cores):
+        intervals = all_intervals["CORE" + str(core)] = []
+        idle = False
+        if series[core] and series[core][0][1] < 0:
+            intervals.append(Interval(0.0,'A'))
+            idle = True
+        for (timestamp, state) in series[core]:
+            value = (timestamp - start) / 1000000.0
+            if state > 0 and not idle:
+                intervals.append(Interval(value,'A'))
+                idle = True
+            elif state <= 0 and idle:
+                intervals.append(Interval(value,'E'))
+                idle = False
+        if idle:
+            intervals.append(Interval((end - start) / 1000000.0,'E'))
+    return (all_intervals, (end - start) / 1000000.0)
+
 def adjust_last_interval(all_intervals,num_cores, collection_duration):
     
     for cores in range(0,num_cores):
@@ -143,8 +176,14 @@ def get_overlapping_intervals_duration(all,num_cores):
 
 def main(argv):
     
-    collection_duration = get_collection_duration(argv)
-    all_intervals=collect_intervals(argv,10)
+    if os.path.isdir(argv):
+        #a profiler report directory with an idle trace; analyze pulls in matplotlib, 
+        #which SoCWatch traces do not need
+        import analyze
+        (all_intervals, collection_duration) = collect_trace_intervals(analyze.read_stats_dir(argv),10)
+    else:
+        collection_duration = get_collection_duration(argv)
+        all_intervals=collect_intervals(argv,10)
     
     #The last interval doesn't have duration if the c state of the core remains the same we
     #so we adjust it with the collection duration
@@ -8,12 +8,24 @@ import logging
 import os
 import sys
 import socket
+import socketserver
 import time
 import threading
 import subprocess
 import re
+import math
+import array
+import bisect
+import signal
+import configparser
+import concurrent.futures
+import json
+import struct
+import fcntl
+import importlib
+import select
+import inspect
 
-# TODO: ProfilerGroup has a tick thread that wakes up at the minimum sampling period and wakes up each profiler if it has to wake up
 # TODO: Use sampling period and sampling length
 # def power_state_diff(new_vector, old_vector):
 #     diff = []
@@ -21,40 +33,497 @@ import re
 #         diff.append([x[0] - x[1] for x in zip(new, old)])
 #     return diff
  
+def parse_cpu_list(cpu_list):
+    """Parses a cpu list such as 0-3,8 into a list of cpu ids"""
+    cpus = []
+    for r in cpu_list.split(','):
+        if '-' in r:
+            (first, last) = r.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(r))
+    return cpus
+
+def pin_threads(cpus):
+    """Restricts every thread of the process to CPUS.
+
+    Threads and child processes created afterwards inherit the affinity of their 
+    creator, so pinning the existing threads covers all later ones too.
+    """
+    for tid in os.listdir('/proc/self/task'):
+        os.sched_setaffinity(int(tid), cpus)
+
+def sleep_until_ns(deadline_ns):
+    """Sleeps until the monotonic clock reaches DEADLINE_NS"""
+    timeout_ns = deadline_ns - time.monotonic_ns()
+    if timeout_ns > 0:
+        time.sleep(timeout_ns / 1000000000)
+
+class Timeseries:
+    """Timeseries stored as two packed columns of 64-bit nanosecond timestamps and double values"""
+    def __init__(self, timestamps=None, values=None, first_seq=0):
+        self.timestamps = timestamps if timestamps is not None else array.array('q')
+        self.values = values if values is not None else array.array('d')
+        # sequence number of the first retained sample; samples keep their 
+        # sequence number when older ones are released
+        self.first_seq = first_seq
+        self.overwritten = 0
+
+    def append(self, timestamp, value):
+        self.timestamps.append(timestamp)
+        self.values.append(value)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            (start, _, _) = index.indices(len(self))
+            return Timeseries(self.timestamps[index], self.values[index], self.first_seq + start)
+        return (self.timestamps[index], self.values[index])
+
+    def next_seq(self):
+        return self.first_seq + len(self)
+
+    def since(self, seq, count):
+        """Returns up to count samples starting at sequence number seq"""
+        start = max(seq - self.first_seq, 0)
+        # a sampler may be between appending a timestamp and its value
+        stop = min(start + count, len(self.timestamps), len(self.values))
+        return self[start:stop]
+
+    def seq_at(self, timestamp):
+        """Returns the sequence number of the first sample taken at or after timestamp"""
+        return self.first_seq + bisect.bisect_left(self.timestamps, timestamp)
+
+    def release(self, seq):
+        """Drops the samples preceding sequence number seq"""
+        count = min(seq - self.first_seq, len(self))
+        if count > 0:
+            del self.timestamps[:count]
+            del self.values[:count]
+            self.first_seq += count
+
+    def __iter__(self):
+        return zip(self.timestamps, self.values)
+
+    def tolist(self):
+        return list(zip(self.timestamps.tolist(), self.values.tolist()))
+
+class RingTimeseries:
+    """Fixed-capacity timeseries that overwrites its oldest samples once full.
+
+    Sample seq lives at slot seq % capacity, so appending is O(1) and the storage 
+    is allocated once up front. Reads return copies as a linear Timeseries.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array.array('q', bytes(8 * capacity))
+        self.values = array.array('d', bytes(8 * capacity))
+        self.first_seq = 0
+        self.count = 0
+        self.overwritten = 0
+
+    def append(self, timestamp, value):
+        slot = (self.first_seq + self.count) % self.capacity
+        self.timestamps[slot] = timestamp
+        self.values[slot] = value
+        if self.count == self.capacity:
+            self.first_seq += 1
+            self.overwritten += 1
+        else:
+            self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def next_seq(self):
+        return self.first_seq + self.count
+
+    def linearize(self, start_seq, stop_seq):
+        """Copies the samples with sequence numbers in [start_seq, stop_seq) into a Timeseries"""
+        start_seq = max(start_seq, self.first_seq)
+        stop_seq = min(stop_seq, self.next_seq())
+        t = Timeseries(first_seq=start_seq)
+        seq = start_seq
+        while seq < stop_seq:
+            slot = seq % self.capacity
+            end = min(self.capacity, slot + stop_seq - seq)
+            t.timestamps.extend(self.timestamps[slot:end])
+            t.values.extend(self.values[slot:end])
+            seq += end - slot
+        return t
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            (start, stop, _) = index.indices(self.count)
+            return self.linearize(self.first_seq + start, self.first_seq + stop)
+        if index < 0:
+            index += self.count
+        slot = (self.first_seq + index) % self.capacity
+        return (self.timestamps[slot], self.values[slot])
+
+    def __iter__(self):
+        return iter(self.linearize(self.first_seq, self.next_seq()))
+
+    def seq_at(self, timestamp):
+        """Returns the sequence number of the first sample taken at or after timestamp.
+
+        Bisects over the slots in place rather than over a linearized copy.
+        """
+        lo = self.first_seq
+        hi = self.next_seq()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamps[mid % self.capacity] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def since(self, seq, count):
+        """Returns up to count samples starting at sequence number seq"""
+        seq = max(seq, self.first_seq)
+        return self.linearize(seq, seq + count)
+
+    def release(self, seq):
+        """Drops the samples preceding sequence number seq"""
+        count = min(seq - self.first_seq, self.count)
+        if count > 0:
+            self.first_seq += count
+            self.count -= count
+
+    def tolist(self):
+        return self.linearize(self.first_seq, self.next_seq()).tolist()
+
+def new_timeseries(capacity=None):
+    return RingTimeseries(capacity) if capacity else Timeseries()
+
+def record_sample(timeseries, key, timestamp, value, capacity=None):
+    t = timeseries.get(key)
+    if t is None:
+        t = timeseries[key] = new_timeseries(capacity)
+    t.append(timestamp, value)
+
+aggregate_stats = ['first', 'last', 'min', 'max', 'mean', 'count', 'rate']
+
+def aggregate_timeseries(t, window_ns, offset_ns, stats, counter=False):
+    """Aggregates a timeseries into fixed windows and returns a Timeseries per stat.
+
+    Windows are aligned to multiples of window_ns in wall clock time, so the windows 
+    of different metrics and hosts line up, and every aggregate is stamped with the 
+    start of its window. The rate of a counter is its increase per second from the 
+    last sample of the previous window, or from the first sample of the window for 
+    the first one; windows where the counter went backwards have no rate.
+    """
+    stats = [stat for stat in stats if stat != 'rate' or counter]
+    aggregates = {stat: Timeseries() for stat in stats}
+    previous = None
+    window = None
+    for (timestamp, value) in t:
+        w = (timestamp + offset_ns) // window_ns
+        if w != window:
+            if window is not None:
+                previous = add_window(aggregates, window * window_ns - offset_ns, samples, previous)
+            window = w
+            samples = []
+        samples.append((timestamp, value))
+    if window is not None:
+        add_window(aggregates, window * window_ns - offset_ns, samples, previous)
+    return aggregates
+
+def add_window(aggregates, timestamp, samples, previous):
+    """Appends the aggregates of the samples of one window and returns its last sample"""
+    values = [value for (_, value) in samples]
+    for (stat, t) in aggregates.items():
+        if stat == 'first':
+            t.append(timestamp, values[0])
+        elif stat == 'last':
+            t.append(timestamp, values[-1])
+        elif stat == 'min':
+            t.append(timestamp, min(values))
+        elif stat == 'max':
+            t.append(timestamp, max(values))
+        elif stat == 'mean':
+            t.append(timestamp, sum(values) / len(values))
+        elif stat == 'count':
+            t.append(timestamp, len(values))
+        elif stat == 'rate':
+            (first_timestamp, first_value) = previous or samples[0]
+            (last_timestamp, last_value) = samples[-1]
+            if last_timestamp > first_timestamp and last_value >= first_value:
+                t.append(timestamp, (last_value - first_value) * 1000000000 / (last_timestamp - first_timestamp))
+    return samples[-1]
+
+class PersistentFile:
+    """Keeps a file open across samples and re-reads it from offset 0 with pread"""
+    def __init__(self, path, bufsize=64):
+        self.path = path
+        self.fd = None
+        self.fd = os.open(path, os.O_RDONLY)
+        self.buf = bytearray(bufsize)
+
+    def read(self):
+        nbytes = os.preadv(self.fd, [self.buf], 0)
+        while nbytes == len(self.buf):
+            self.buf = bytearray(2 * len(self.buf))
+            nbytes = os.preadv(self.fd, [self.buf], 0)
+        return self.buf[:nbytes]
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self):
+        # files of samplers dropped by a reconfiguration are closed once unreferenced
+        self.close()
+
+class OverheadStats:
+    """Running summary of an overhead metric over a whole run, whatever samples are retained.
+
+    The p99 comes from a histogram with buckets 2^(1/buckets_per_octave) apart, so it 
+    is the upper bound of the bucket holding the nearest-rank sample, within about 9%.
+    """
+    buckets_per_octave = 8
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = None
+        self.histogram = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = value if self.max is None else max(self.max, value)
+        bucket = math.ceil(OverheadStats.buckets_per_octave * math.log2(value)) if value > 1 else 0
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def summary(self):
+        rank = math.ceil(0.99 * self.count)
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= rank:
+                break
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count,
+            'p99': min(2 ** (bucket / OverheadStats.buckets_per_octave), self.max),
+            'max': self.max,
+        }
+
+class SpillLog:
+    """Append-only on-disk log of every recorded sample that survives the profiler.
+
+    Samples are fixed-size records of a metric id, a wall clock timestamp in ns and 
+    a value, appended to samples.log; metric ids are line numbers of names.log. 
+    Samplers only append to a pending list, and a writer thread writes it out every 
+    flush_interval seconds as one block, names first, so that every record in the 
+    log refers to a complete name. Trailing partial records and names left by a 
+    crash are dropped when the log is opened again.
+    """
+    record_format = struct.Struct('<Iqd')
+    samples_file_name = 'samples.log'
+    names_file_name = 'names.log'
+
+    def __init__(self, directory, flush_interval=1):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.samples_path = os.path.join(directory, SpillLog.samples_file_name)
+        self.names_path = os.path.join(directory, SpillLog.names_file_name)
+        self.pending = []
+        # guards pending; the writer swaps it out and formats records without it
+        self.lock = threading.Lock()
+        # serializes writing with reset and flush
+        self.io_lock = threading.Lock()
+        self.offset_ns = 0
+        self.recover()
+        self.terminate_thread = threading.Condition()
+        self.thread = threading.Thread(target=SpillLog.writer_thread, args=(self,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def recover(self):
+        """Opens the log of a previous run, dropping what a crash left half written"""
+        self.ids = {}
+        if os.path.exists(self.names_path):
+            with open(self.names_path, 'rb') as f:
+                data = f.read()
+            lines = data.split(b'\n')[:-1]
+            self.ids = {name.decode(): i for (i, name) in enumerate(lines)}
+            os.truncate(self.names_path, sum([len(name) + 1 for name in lines]))
+        self.names_fd = os.open(self.names_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.samples_fd = os.open(self.samples_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        size = os.fstat(self.samples_fd).st_size
+        os.ftruncate(self.samples_fd, size - size % SpillLog.record_format.size)
+
+    def append(self, key, timestamp, value):
+        with self.lock:
+            self.pending.append((key, timestamp, value))
+
+    def writer_thread(self):
+        self.terminate_thread.acquire()
+        while True:
+            self.terminate_thread.wait(timeout=self.flush_interval)
+            self.terminate_thread.release()
+            self.flush()
+            self.terminate_thread.acquire()
+
+    def flush(self):
+        """Writes out the pending samples"""
+        with self.io_lock:
+            with self.lock:
+                (pending, self.pending) = (self.pending, [])
+            if not pending:
+                return
+            names = []
+            block = bytearray(len(pending) * SpillLog.record_format.size)
+            for (i, (key, timestamp, value)) in enumerate(pending):
+                metric_id = self.ids.get(key)
+                if metric_id is None:
+                    metric_id = self.ids[key] = len(self.ids)
+                    names.append(key)
+                SpillLog.record_format.pack_into(block, i * SpillLog.record_format.size, metric_id, timestamp + self.offset_ns, value)
+            if names:
+                os.write(self.names_fd, ''.join([name + '\n' for name in names]).encode())
+                os.fsync(self.names_fd)
+            os.write(self.samples_fd, block)
+            os.fsync(self.samples_fd)
+
+    def reset(self, offset_ns):
+        """Discards the log of the previous run; OFFSET_NS maps sample timestamps to wall clock"""
+        with self.io_lock:
+            with self.lock:
+                self.pending = []
+            self.offset_ns = offset_ns
+            self.ids = {}
+            os.ftruncate(self.names_fd, 0)
+            os.ftruncate(self.samples_fd, 0)
+
+    def names(self):
+        with self.io_lock:
+            return sorted(self.ids, key=self.ids.get)
+
+    def read(self, start, count):
+        """Returns up to count records starting at record number start as bytes"""
+        size = SpillLog.record_format.size
+        with self.io_lock:
+            return os.pread(self.samples_fd, count * size, start * size)
+
 class EventProfiling:
+    name = None
+    # the samples per second per metric of profilers driven by events rather than by 
+    # a sampling period, used to size their ring buffers
+    event_rate = None
+
     def __init__(self, sampling_period = 0, sampling_length = 1):
         self.terminate_thread = threading.Condition()
         self.is_active = False
         self.sampling_period = sampling_period
         self.sampling_length = sampling_length
+        self.scheduled = False
+        # held while recording samples and while copying the timeseries for a report
+        self.lock = threading.Lock()
+        # when set, every timeseries is a ring buffer holding the last capacity samples
+        self.capacity = None
+        # when set, every sample is also appended to this SpillLog
+        self.spill = None
+        # OverheadStats of the run by overhead metric, kept apart from the timeseries 
+        # since followers and ring buffers drop samples
+        self.overhead_stats = {}
+
+    def is_periodic(self):
+        # Profilers whose sample() returns immediately can be driven by a ProfilerGroup tick.
+        # Profilers that block for sampling_length keep their own profile thread.
+        return self.sampling_period > 0 and self.sampling_length == 0
 
     def profile_thread(self):
         logging.info("Profiling thread started")
+        deadline_ns = None
         self.terminate_thread.acquire()
         while self.is_active:
-            timestamp = str(int(time.time()))
+            timestamp = time.monotonic_ns()
             self.terminate_thread.release()
-            self.sample(timestamp)
+            self.timed_sample(timestamp, deadline_ns)
             self.terminate_thread.acquire()
             if self.is_active:
-                self.terminate_thread.wait(timeout=self.sampling_period - self.sampling_length)
+                timeout = self.sampling_period - self.sampling_length
+                deadline_ns = time.monotonic_ns() + int(max(0, timeout) * 1000000000)
+                self.terminate_thread.wait(timeout=timeout)
         self.terminate_thread.release()
-        timestamp = str(int(time.time()))
+        timestamp = time.monotonic_ns()
         self.zerosample(timestamp)
         logging.info("Profiling thread terminated")
 
+    def timed_sample(self, timestamp, deadline_ns=None):
+        """Takes a sample and records what it cost.
+
+        The wall clock and cpu time spent in sample() are recorded as 
+        profiler.<name>.cost_us and profiler.<name>.cpu_us, and how late the 
+        sample was taken with respect to deadline_ns as profiler.<name>.lateness_us. 
+        The cpu time is that of the calling thread, so it excludes the child 
+        processes of samplers that fork.
+        """
+        start_ns = time.perf_counter_ns()
+        start_cpu_ns = time.thread_time_ns()
+        self.sample(timestamp)
+        cpu_us = (time.thread_time_ns() - start_cpu_ns) / 1000
+        cost_us = (time.perf_counter_ns() - start_ns) / 1000
+        lateness_us = None if deadline_ns is None else (timestamp - deadline_ns) / 1000
+        self.record_overhead(timestamp, cost_us, cpu_us, lateness_us)
+
+    def record_overhead(self, timestamp, cost_us, cpu_us, lateness_us=None):
+        overheads = [('cost_us', cost_us), ('cpu_us', cpu_us)]
+        if lateness_us is not None:
+            overheads.append(('lateness_us', lateness_us))
+        with self.lock:
+            for (metric, value) in overheads:
+                self.record('profiler.{}.{}'.format(self.name, metric), timestamp, value)
+                stats = self.overhead_stats.get(metric)
+                if stats is None:
+                    stats = self.overhead_stats[metric] = OverheadStats()
+                stats.add(value)
+
+    def new_timeseries(self):
+        return new_timeseries(self.capacity)
+
+    def is_counter(self, key):
+        """Tells whether metric key only ever increases, so that it can be aggregated into a rate"""
+        return False
+
+    def close(self):
+        """Releases what the profiler keeps open across runs other than PersistentFiles"""
+        pass
+
+    def record(self, key, timestamp, value):
+        record_sample(self.timeseries, key, timestamp, value, self.capacity)
+        if self.spill is not None:
+            self.spill.append(key, timestamp, value)
+
+    def report(self):
+        return {key: t.tolist() for (key, t) in self.timeseries.items()}
+
     def start(self):
         self.clear()
+        if self.scheduled:
+            return
         if self.sampling_period:
             self.is_active=True
             self.thread = threading.Thread(target=EventProfiling.profile_thread, args=(self,))
             self.thread.daemon = True
             self.thread.start()
         else:
-            timestamp = str(int(time.time()))
-            self.sample(timestamp)
+            timestamp = time.monotonic_ns()
+            self.timed_sample(timestamp)
 
     def stop(self):
+        if self.scheduled:
+            return
         if self.sampling_period:
             self.terminate_thread.acquire()
             self.interrupt_sample()
@@ -62,38 +531,77 @@ class EventProfiling:
             self.terminate_thread.notify()
             self.terminate_thread.release()
         else:
-            timestamp = str(int(time.time()))
-            self.sample(timestamp)
+            timestamp = time.monotonic_ns()
+            self.timed_sample(timestamp)
 
 class RaplCountersProfiling(EventProfiling):
+    name = 'rapl'
     raplcounters_path = '/sys/class/powercap/intel-rapl/'   
 
     def __init__(self, sampling_period=0):
-        super().__init__(sampling_period)
+        super().__init__(sampling_period, sampling_length=0)
         self.domain_names = {}
         self.domain_names = RaplCountersProfiling.power_domain_names()
+        # energy_uj wraps around to zero once it exceeds max_energy_range_uj, which is read only once
+        self.max_energy_range = {}
+        for domain, energy_path in self.domain_names.items():
+            max_energy_range_path = os.path.join(os.path.dirname(energy_path), 'max_energy_range_uj')
+            with open(max_energy_range_path) as f:
+                self.max_energy_range[domain] = int(f.read())
+        self.files = None
+        self.last_sample = {}
+        self.energy = {}
         self.timeseries = {}
 
     @staticmethod
     def power_domain_names():
         raplcounters_path = RaplCountersProfiling.raplcounters_path
         if not os.path.exists(raplcounters_path):
-            return []
+            return {}
         domain_names = {}
         
         #Find all supported domains of the system
         for root, subdirs, files in os.walk(raplcounters_path):
             for subdir in subdirs:
                 if "intel-rapl" in subdir:
-                    domain_names[open("{}/{}/{}".format(root, subdir,'name'), "r").read().strip()]= os.path.join(root,subdir,'energy_uj')    
+                    name = open("{}/{}/{}".format(root, subdir,'name'), "r").read().strip()
+                    # sub-zones such as core, uncore and dram repeat in every package
+                    if subdir.count(':') > 1:
+                        parent_name = open("{}/{}".format(root, 'name'), "r").read().strip()
+                        name = "{}/{}".format(parent_name, name)
+                    domain_names[name]= os.path.join(root,subdir,'energy_uj')    
         return domain_names
 
-   
     def sample(self, timestamp):
-         for domain in self.domain_names:
-                value = open(self.domain_names[domain], "r").read().strip()
-                self.timeseries.setdefault(domain, []).append((timestamp, value))
-       
+        raw_energies = [(domain, int(f.read())) for (domain, f) in self.files.items()]
+        with self.lock:
+            for (domain, raw_energy) in raw_energies:
+                if domain in self.last_sample:
+                    (last_timestamp, last_raw_energy) = self.last_sample[domain]
+                    delta = raw_energy - last_raw_energy
+                    if delta < 0:
+                        delta += self.max_energy_range[domain]
+                    self.energy[domain] += delta
+                    # uJ per ns to W
+                    power = delta * 1000.0 / (timestamp - last_timestamp)
+                    self.record("rapl.{}.power_w".format(domain), timestamp, power)
+                else:
+                    self.energy[domain] = raw_energy
+                self.last_sample[domain] = (timestamp, raw_energy)
+                # the recorded energy is unwrapped, so it increases monotonically over the run
+                self.record(domain, timestamp, self.energy[domain])
+
+    def start(self):
+        if self.files is None:
+            self.files = {}
+            for domain, energy_path in self.domain_names.items():
+                self.files[domain] = PersistentFile(energy_path, bufsize=32)
+        self.last_sample = {}
+        self.energy = {}
+        super().start()
+
+    def is_counter(self, key):
+        return key in self.domain_names
 
     def interrupt_sample(self):
         pass
@@ -104,18 +612,24 @@ class RaplCountersProfiling(EventProfiling):
     def clear(self):
         self.timeseries = {}
 
-    def report(self):
-        return self.timeseries
-
 class PerfEventProfiling(EventProfiling):
-    def __init__(self, sampling_period=1, sampling_length=1):
+    name = 'perf'
+
+    def __init__(self, sampling_period=1, sampling_length=1, streaming=False):
         super().__init__(sampling_period, sampling_length)
+        self.streaming = streaming
+        self.process = None
         self.perf_path = self.find_perf_path()
         logging.info('Perf found at {}'.format(self.perf_path)) 
         self.events = self.get_perf_power_events()
         self.timeseries = {}
         for e in self.events:
-            self.timeseries[e] = []
+            self.timeseries[e] = self.new_timeseries()
+
+    def is_periodic(self):
+        if self.streaming:
+            return False
+        return super().is_periodic()
 
     def find_perf_path(self):
         kernel_uname = os.popen('uname -a').read().strip()
@@ -139,37 +653,129 @@ class PerfEventProfiling(EventProfiling):
         cmd = ['sudo', self.perf_path, 'stat', '-a', '-e', events_str, 'sleep', str(self.sampling_length)]
         result = subprocess.run(cmd, stdout=subprocess.PIPE,stderr=subprocess.PIPE)
         out = result.stdout.decode('utf-8').splitlines() + result.stderr.decode('utf-8').splitlines()
-        for e in self.events:
-            for l in out:
-                l = l.lstrip()
-                m = re.match("(.*)\s+.*\s+{}".format(e), l)
-                if m:
-                    value = m.group(1)
-                    self.timeseries[e].append((timestamp, str(float(value.replace(',', '')))))
+        with self.lock:
+            for e in self.events:
+                for l in out:
+                    l = l.lstrip()
+                    m = re.match("(.*)\s+.*\s+{}".format(e), l)
+                    if m:
+                        value = m.group(1)
+                        self.record(e, timestamp, float(value.replace(',', '')))
     
     # FIXME: Currently, we add a dummy zero sample when we finish sampling. 
     # This helps us to determine the sampling duration later when we analyze the stats
     # It would be nice to have a more clear solution
     def zerosample(self, timestamp):
-        for e in self.events:
-            self.timeseries[e].append((timestamp, str(0.0)))
+        with self.lock:
+            for e in self.events:
+                self.record(e, timestamp, 0.0)
 
     def interrupt_sample(self):
         os.system('sudo pkill -2 sleep')
 
+    # In streaming mode a single perf stat process prints the counts of every 
+    # interval as CSV lines (time,count,unit,event,...) for the whole run
+    def reader_thread(self):
+        logging.info("Perf reader thread started")
+        interval_ns = int(self.sampling_period * 1000000000)
+        # the cost of parsing the lines of an interval is recorded once the next interval begins
+        interval_timestamp = None
+        cost_ns = cpu_ns = 0
+        for l in self.process.stderr:
+            start_ns = time.perf_counter_ns()
+            start_cpu_ns = time.thread_time_ns()
+            fields = l.decode('utf-8').strip().split(',')
+            if len(fields) < 4:
+                continue
+            event = fields[3]
+            if event not in self.timeseries:
+                continue
+            try:
+                value = float(fields[1])
+            except ValueError:
+                # <not counted> or <not supported>
+                continue
+            # perf stamps each interval at its end but samples are stamped at the beginning 
+            # of the window they cover, like the ones taken by sample()
+            timestamp = self.start_time_ns + int(float(fields[0]) * 1000000000) - interval_ns
+            if timestamp != interval_timestamp:
+                if interval_timestamp is not None:
+                    self.record_overhead(interval_timestamp, cost_ns / 1000, cpu_ns / 1000)
+                interval_timestamp = timestamp
+                cost_ns = cpu_ns = 0
+            with self.lock:
+                self.record(event, timestamp, value)
+            cpu_ns += time.thread_time_ns() - start_cpu_ns
+            cost_ns += time.perf_counter_ns() - start_ns
+        if interval_timestamp is not None:
+            self.record_overhead(interval_timestamp, cost_ns / 1000, cpu_ns / 1000)
+        logging.info("Perf reader thread terminated")
+
+    def start_streaming(self):
+        self.clear()
+        events_str = ','.join(self.events)
+        interval_ms = int(self.sampling_period * 1000)
+        cmd = [self.perf_path, 'stat', '-a', '-I', str(interval_ms), '-x', ',', '-e', events_str]
+        if os.geteuid() != 0:
+            cmd = ['sudo'] + cmd
+        self.start_time_ns = time.monotonic_ns()
+        self.process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        self.thread = threading.Thread(target=PerfEventProfiling.reader_thread, args=(self,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def signal_streaming(self, signame):
+        """Sends a signal to the streaming perf, which may be owned by root.
+
+        An unprivileged daemon cannot signal the sudo process it started, so the 
+        signal is sent through sudo to perf, the child of that sudo process.
+        """
+        if os.geteuid() == 0:
+            self.process.send_signal(getattr(signal, 'SIG' + signame))
+            return
+        pids = subprocess.run(['pgrep', '-P', str(self.process.pid)], stdout=subprocess.PIPE).stdout.split()
+        pids = [pid.decode() for pid in pids] or [str(self.process.pid)]
+        subprocess.run(['sudo', 'kill', '-' + signame] + pids)
+
+    def stop_streaming(self):
+        if not self.process:
+            return
+        # perf prints the last interval and exits on SIGINT
+        self.signal_streaming('INT')
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.signal_streaming('KILL')
+            self.process.wait()
+        self.thread.join(timeout=5)
+        self.process = None
+        timestamp = time.monotonic_ns()
+        self.zerosample(timestamp)
+
+    def start(self):
+        if self.streaming:
+            self.start_streaming()
+        else:
+            super().start()
+
+    def stop(self):
+        if self.streaming:
+            self.stop_streaming()
+        else:
+            super().stop()
+
     def clear(self):
         self.timeseries = {}
         for e in self.events:
-            self.timeseries[e] = []
-
-    def report(self):
-        return self.timeseries
+            self.timeseries[e] = self.new_timeseries()
 
 class MpstatProfiling(EventProfiling):
+    name = 'mpstat'
+
     def __init__(self, sampling_period=1, sampling_length=1):
         super().__init__(sampling_period, sampling_length)
         self.timeseries = {}
-        self.timeseries['cpu_util'] = []
+        self.timeseries['cpu_util'] = self.new_timeseries()
 
     def sample(self, timestamp):
         cmd = ['mpstat', '1', '1']
@@ -178,8 +784,9 @@ class MpstatProfiling(EventProfiling):
         for l in lines:
             if 'Average' in l:
                 idle_val = float(l.split()[-1])
-                util_val = str(100.00-idle_val)
-                self.timeseries['cpu_util'].append((timestamp, util_val))
+                util_val = 100.00-idle_val
+                with self.lock:
+                    self.record('cpu_util', timestamp, util_val)
                 return 
 
     def interrupt_sample(self):
@@ -190,17 +797,737 @@ class MpstatProfiling(EventProfiling):
 
     def clear(self):
         self.timeseries = {}
-        self.timeseries['cpu_util'] = []
+        self.timeseries['cpu_util'] = self.new_timeseries()
 
-    def report(self):
-        return self.timeseries
+class ProcStatProfiling(EventProfiling):
+    """Per-cpu utilization breakdown computed from /proc/stat jiffy deltas"""
+    name = 'procstat'
+    procstat_path = '/proc/stat'
+    # columns of a cpu line in /proc/stat
+    fields = ['user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal']
+    # reported metric -> /proc/stat columns it sums up
+    metrics = {
+        'user': ['user', 'nice'],
+        'sys': ['system'],
+        'irq': ['irq'],
+        'softirq': ['softirq'],
+        'idle': ['idle', 'iowait'],
+    }
+
+    def __init__(self, sampling_period=1, cpus=None):
+        super().__init__(sampling_period, sampling_length=0)
+        self.cpus = cpus
+        self.file = None
+        self.last_jiffies = {}
+        self.metric_columns = {}
+        for metric, columns in ProcStatProfiling.metrics.items():
+            self.metric_columns[metric] = [ProcStatProfiling.fields.index(c) for c in columns]
+        self.timeseries = {}
+
+    def read_jiffies(self):
+        jiffies = {}
+        for l in self.file.read().decode().splitlines():
+            if not l.startswith('cpu'):
+                break
+            values = l.split()
+            cpu = values[0]
+            if cpu == 'cpu':
+                cpu = 'all'
+            elif self.cpus is not None and int(cpu[3:]) not in self.cpus:
+                continue
+            jiffies[cpu] = [int(v) for v in values[1:1+len(ProcStatProfiling.fields)]]
+        return jiffies
+
+    def sample(self, timestamp):
+        jiffies = self.read_jiffies()
+        with self.lock:
+            for cpu, values in jiffies.items():
+                last_values = self.last_jiffies.get(cpu)
+                if not last_values:
+                    continue
+                delta = [new - old for (new, old) in zip(values, last_values)]
+                total = sum(delta)
+                if not total:
+                    continue
+                for metric, columns in self.metric_columns.items():
+                    key = 'procstat.{}.{}'.format(cpu, metric)
+                    perc = 100.0 * sum([delta[c] for c in columns]) / total
+                    self.record(key, timestamp, perc)
+        self.last_jiffies = jiffies
+
+    def start(self):
+        if not self.file:
+            self.file = PersistentFile(ProcStatProfiling.procstat_path, bufsize=8192)
+        self.last_jiffies = {}
+        super().start()
+
+    def interrupt_sample(self):
+        pass
+
+    def zerosample(self, timestamp):
+        pass
+
+    def clear(self):
+        self.timeseries = {}
+
+class CpuFreqProfiling(EventProfiling):
+    """Per-cpu frequency from the APERF/MPERF MSRs, or from cpufreq when they cannot be read.
+
+    With MSRs, busy_mhz is the average frequency while the cpu was not halted and 
+    effective_mhz the average over the whole sampling period, halted time counting 
+    as zero. With cpufreq, cur_mhz is the frequency last requested by the governor 
+    and avg_mhz the average of the time_in_state residency over the sampling period.
+    """
+    name = 'cpufreq'
+    msr_path = '/dev/cpu/{}/msr'
+    cpufreq_path = '/sys/devices/system/cpu/cpu{}/cpufreq/'
+    msr_tsc = 0x10
+    msr_mperf = 0xe7
+    msr_aperf = 0xe8
+    msr_platform_info = 0xce
+
+    def __init__(self, sampling_period=1, cpus=None):
+        super().__init__(sampling_period, sampling_length=0)
+        self.cpus = cpus if cpus is not None else list(range(os.cpu_count()))
+        self.msr_files = None
+        self.cpufreq_files = None
+        self.last_counters = {}
+        self.timeseries = {}
+
+    @staticmethod
+    def read_msr(fd, msr):
+        # the msr driver reads the register at the file offset; reading the msr of 
+        # another cpu interrupts it with an IPI
+        return struct.unpack('<Q', os.pread(fd, 8, msr))[0]
+
+    def open_msr_files(self):
+        fds = {}
+        try:
+            for cpu in self.cpus:
+                fds[cpu] = os.open(CpuFreqProfiling.msr_path.format(cpu), os.O_RDONLY)
+            platform_info = CpuFreqProfiling.read_msr(fds[self.cpus[0]], CpuFreqProfiling.msr_platform_info)
+        except OSError as e:
+            logging.info('Cannot read MSRs, falling back to cpufreq: {}'.format(e))
+            for fd in fds.values():
+                os.close(fd)
+            return False
+        # the maximum non-turbo ratio in bits 15:8 is the rate at which MPERF counts
+        self.base_mhz = ((platform_info >> 8) & 0xff) * 100
+        self.msr_files = fds
+        return True
+
+    def open_cpufreq_files(self):
+        self.cpufreq_files = {}
+        for cpu in self.cpus:
+            path = CpuFreqProfiling.cpufreq_path.format(cpu)
+            try:
+                cur_file = PersistentFile(path + 'scaling_cur_freq')
+            except OSError:
+                logging.info('No cpufreq for cpu{}'.format(cpu))
+                continue
+            try:
+                stats_file = PersistentFile(path + 'stats/time_in_state', bufsize=1024)
+            except OSError:
+                stats_file = None
+            self.cpufreq_files[cpu] = (cur_file, stats_file)
+
+    def sample_msr(self, timestamp):
+        counters = {}
+        for (cpu, fd) in self.msr_files.items():
+            counters[cpu] = [CpuFreqProfiling.read_msr(fd, msr) for msr in 
+                [CpuFreqProfiling.msr_tsc, CpuFreqProfiling.msr_mperf, CpuFreqProfiling.msr_aperf]]
+        with self.lock:
+            for (cpu, values) in counters.items():
+                last_values = self.last_counters.get(cpu)
+                if not last_values:
+                    continue
+                (tsc, mperf, aperf) = [(new - old) & 0xffffffffffffffff for (new, old) in zip(values, last_values)]
+                if not tsc or not mperf:
+                    continue
+                self.record('cpufreq.cpu{}.busy_mhz'.format(cpu), timestamp, self.base_mhz * aperf / mperf)
+                self.record('cpufreq.cpu{}.effective_mhz'.format(cpu), timestamp, self.base_mhz * aperf / tsc)
+        self.last_counters = counters
+
+    @staticmethod
+    def parse_time_in_state(data):
+        """Maps every frequency in kHz to the time spent at it, in units of 10ms"""
+        residency = {}
+        for l in data.decode().splitlines():
+            (freq_khz, time) = l.split()
+            residency[int(freq_khz)] = int(time)
+        return residency
+
+    def sample_cpufreq(self, timestamp):
+        samples = {}
+        for (cpu, (cur_file, stats_file)) in self.cpufreq_files.items():
+            cur_mhz = int(cur_file.read()) / 1000
+            residency = CpuFreqProfiling.parse_time_in_state(stats_file.read()) if stats_file else None
+            samples[cpu] = (cur_mhz, residency)
+        with self.lock:
+            for (cpu, (cur_mhz, residency)) in samples.items():
+                self.record('cpufreq.cpu{}.cur_mhz'.format(cpu), timestamp, cur_mhz)
+                last_residency = self.last_counters.get(cpu)
+                if not residency or not last_residency:
+                    continue
+                delta = {freq_khz: time - last_residency.get(freq_khz, 0) for (freq_khz, time) in residency.items()}
+                total = sum(delta.values())
+                if total:
+                    avg_mhz = sum([freq_khz * time for (freq_khz, time) in delta.items()]) / total / 1000
+                    self.record('cpufreq.cpu{}.avg_mhz'.format(cpu), timestamp, avg_mhz)
+        self.last_counters = {cpu: residency for (cpu, (cur_mhz, residency)) in samples.items()}
+
+    def sample(self, timestamp):
+        if self.msr_files:
+            self.sample_msr(timestamp)
+        else:
+            self.sample_cpufreq(timestamp)
+
+    def close(self):
+        for fd in (self.msr_files or {}).values():
+            os.close(fd)
+        self.msr_files = None
+
+    def start(self):
+        if self.msr_files is None and self.cpufreq_files is None:
+            if not self.open_msr_files():
+                self.open_cpufreq_files()
+        self.last_counters = {}
+        super().start()
+
+    def interrupt_sample(self):
+        pass
+
+    def zerosample(self, timestamp):
+        pass
+
+    def clear(self):
+        self.timeseries = {}
+
+class InterruptsProfiling(EventProfiling):
+    """Per-cpu interrupt and softirq rates from /proc/interrupts and /proc/softirqs.
+
+    The layout of each file, i.e. which lines are sampled, what their cpu columns 
+    are and the keys they are recorded under, is compiled once at start, so every 
+    tick only splits the selected lines up to their last sampled column. Interrupts are selected by matching 
+    irq_regex against their device name (or label, for NMI, LOC etc.) and softirqs by 
+    matching softirq_regex against their name. Rates are recorded in events per second 
+    as irq.<irq>-<device>.cpuN and softirq.<name>.cpuN.
+    """
+    name = 'irq'
+    interrupts_path = '/proc/interrupts'
+    softirqs_path = '/proc/softirqs'
+
+    def __init__(self, sampling_period=1, irq_regex=None, softirq_regex=None, cpus=None):
+        super().__init__(sampling_period, sampling_length=0)
+        self.sources = [
+            ('irq', InterruptsProfiling.interrupts_path, re.compile(irq_regex) if irq_regex else None),
+            ('softirq', InterruptsProfiling.softirqs_path, re.compile(softirq_regex) if softirq_regex else None),
+        ]
+        self.cpus = cpus
+        self.files = None
+        self.layouts = {}
+        self.last_counts = {}
+        self.last_timestamp = None
+        self.timeseries = {}
+
+    def compile_layout(self, prefix, data, regex):
+        """Returns the cpu columns to sample, how many fields to split off each line and 
+        the (line number, label, keys) of the lines to sample"""
+        lines = data.split(b'\n')
+        cpus = [int(c[3:]) for c in lines[0].split()]
+        columns = [i for (i, cpu) in enumerate(cpus) if self.cpus is None or cpu in self.cpus]
+        selected = []
+        for (line_no, l) in enumerate(lines[1:], 1):
+            fields = l.split(None, len(cpus) + 1)
+            # skips totals such as ERR and MIS, which have a single column
+            if len(fields) < len(cpus) + 1 or not fields[len(cpus)].isdigit():
+                continue
+            label = fields[0]
+            name = label.decode().rstrip(':')
+            description = fields[len(cpus) + 1].decode() if len(fields) > len(cpus) + 1 else ''
+            device = description.split()[-1] if name.isdigit() and description else name
+            if regex and not regex.search(device):
+                continue
+            if name.isdigit():
+                name = '{}-{}'.format(name, device)
+            name = re.sub('[^A-Za-z0-9_-]', '_', name)
+            keys = ['{}.{}.cpu{}'.format(prefix, name, cpus[i]) for i in columns]
+            selected.append((line_no, label, keys))
+        maxsplit = max(columns, default=-1) + 2
+        return (columns, maxsplit, selected)
+
+    def read_counts(self, prefix, regex, f):
+        """Returns the counts of the selected lines by key, recompiling the layout if lines were added or removed"""
+        data = f.read()
+        lines = data.split(b'\n')
+        (columns, maxsplit, selected) = self.layouts[prefix]
+        counts = {}
+        for (line_no, label, keys) in selected:
+            fields = lines[line_no].split(None, maxsplit) if line_no < len(lines) else None
+            if not fields or fields[0] != label:
+                logging.info('Recompiling {} layout'.format(f.path))
+                self.layouts[prefix] = self.compile_layout(prefix, data, regex)
+                return {}
+            for (key, i) in zip(keys, columns):
+                counts[key] = int(fields[1 + i])
+        return counts
+
+    def sample(self, timestamp):
+        counts = {}
+        for (prefix, path, regex) in self.sources:
+            counts.update(self.read_counts(prefix, regex, self.files[prefix]))
+        with self.lock:
+            if self.last_timestamp is not None:
+                elapsed = (timestamp - self.last_timestamp) / 1000000000
+                for (key, count) in counts.items():
+                    last_count = self.last_counts.get(key)
+                    if last_count is not None:
+                        self.record(key, timestamp, (count - last_count) / elapsed)
+        self.last_counts = counts
+        self.last_timestamp = timestamp
+
+    def start(self):
+        if self.files is None:
+            self.files = {}
+            for (prefix, path, regex) in self.sources:
+                self.files[prefix] = PersistentFile(path, bufsize=65536)
+                self.layouts[prefix] = self.compile_layout(prefix, self.files[prefix].read(), regex)
+        self.last_counts = {}
+        self.last_timestamp = None
+        super().start()
+
+    def interrupt_sample(self):
+        pass
+
+    def zerosample(self, timestamp):
+        pass
+
+    def clear(self):
+        self.timeseries = {}
+
+class EthtoolStats:
+    """Reads the driver statistics of a network interface, as ethtool -S does, with the SIOCETHTOOL ioctl"""
+    siocethtool = 0x8946
+    ethtool_gsset_info = 0x37
+    ethtool_gstrings = 0x1b
+    ethtool_gstats = 0x1d
+    eth_ss_stats = 1
+    eth_gstring_len = 32
+
+    def __init__(self, interface):
+        self.interface = interface
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        buf = self.ioctl(struct.pack('IIQI', EthtoolStats.ethtool_gsset_info, 0, 1 << EthtoolStats.eth_ss_stats, 0))
+        (cmd, reserved, mask, n_stats) = struct.unpack('IIQI', buf.tobytes())
+        buf = self.ioctl(struct.pack('III', EthtoolStats.ethtool_gstrings, EthtoolStats.eth_ss_stats, n_stats) + 
+            bytes(EthtoolStats.eth_gstring_len * n_stats))
+        strings = buf[12:].tobytes()
+        self.names = [strings[i:i+EthtoolStats.eth_gstring_len].rstrip(b'\0').decode() 
+            for i in range(0, len(strings), EthtoolStats.eth_gstring_len)]
+        # the request buffer is allocated once and reused by every read
+        self.stats_buf = array.array('B', struct.pack('II', EthtoolStats.ethtool_gstats, n_stats) + bytes(8 * n_stats))
+
+    def ioctl(self, request):
+        buf = array.array('B', request)
+        ifreq = struct.pack('16sP', self.interface.encode(), buf.buffer_info()[0])
+        fcntl.ioctl(self.sock.fileno(), EthtoolStats.siocethtool, ifreq)
+        return buf
+
+    def read(self):
+        ifreq = struct.pack('16sP', self.interface.encode(), self.stats_buf.buffer_info()[0])
+        fcntl.ioctl(self.sock.fileno(), EthtoolStats.siocethtool, ifreq)
+        return array.array('Q', self.stats_buf[8:].tobytes())
+
+    def close(self):
+        self.sock.close()
+
+class NetDevProfiling(EventProfiling):
+    """Network throughput, drop and TCP counter rates of the network interfaces.
+
+    Per interface, rx/tx bytes, packets, errs and drops per second come from 
+    /proc/net/dev. Per queue, they come from the driver statistics whose ethtool 
+    names look like rx0_packets, rx_queue_0_bytes or tx-0.packets, since sysfs has 
+    no per-queue packet counters. sysfs adds the tx queue timeouts per second and 
+    the bytes in flight in the queue (a gauge). Tcp and TcpExt counters of 
+    /proc/net/snmp and /proc/net/netstat are recorded as net.tcp.<counter>.
+    """
+    name = 'net'
+    netdev_path = '/proc/net/dev'
+    snmp_path = '/proc/net/snmp'
+    netstat_path = '/proc/net/netstat'
+    queues_path = '/sys/class/net/{}/queues/'
+    # /proc/net/dev columns -> reported metric
+    netdev_fields = {0: 'rx_bytes', 1: 'rx_packets', 2: 'rx_errs', 3: 'rx_drops', 
+        8: 'tx_bytes', 9: 'tx_packets', 10: 'tx_errs', 11: 'tx_drops'}
+    tcp_counters = {
+        'Tcp:': ['InSegs', 'OutSegs', 'RetransSegs', 'InErrs'],
+        'TcpExt:': ['ListenOverflows', 'ListenDrops', 'TCPBacklogDrop'],
+    }
+    queue_stat_re = re.compile('^(rx|tx)[_-]?(?:queue_)?([0-9]+)[._](?:rx_|tx_)?(packets|bytes|drops|dropped)$')
+
+    def __init__(self, sampling_period=1, interface_regex=None):
+        super().__init__(sampling_period, sampling_length=0)
+        self.interface_regex = re.compile(interface_regex) if interface_regex else None
+        self.files = None
+        self.last_counters = {}
+        self.last_timestamp = None
+        self.timeseries = {}
+
+    @staticmethod
+    def key_name(name):
+        return re.sub('[^A-Za-z0-9_-]', '_', name)
+
+    def open_files(self):
+        self.netdev_file = PersistentFile(NetDevProfiling.netdev_path, bufsize=4096)
+        self.tcp_files = [PersistentFile(path, bufsize=8192) for path in [NetDevProfiling.snmp_path, NetDevProfiling.netstat_path]]
+        self.interfaces = []
+        for l in self.netdev_file.read().decode().splitlines()[2:]:
+            interface = l.split(':')[0].strip()
+            if not self.interface_regex or self.interface_regex.search(interface):
+                self.interfaces.append(interface)
+        # (interface, stats, [(stat index, key)])
+        self.ethtool = []
+        # (key, file, is_counter)
+        self.files = []
+        for interface in self.interfaces:
+            prefix = 'net.{}.'.format(NetDevProfiling.key_name(interface))
+            try:
+                stats = EthtoolStats(interface)
+            except OSError as e:
+                logging.info('No ethtool statistics for {}: {}'.format(interface, e))
+                stats = None
+            if stats:
+                selected = []
+                for (i, stat_name) in enumerate(stats.names):
+                    m = NetDevProfiling.queue_stat_re.match(stat_name)
+                    if m:
+                        (direction, queue, metric) = m.groups()
+                        metric = 'drops' if metric == 'dropped' else metric
+                        selected.append((i, prefix + '{}q{}_{}'.format(direction, queue, metric)))
+                if selected:
+                    self.ethtool.append((interface, stats, selected))
+                else:
+                    stats.close()
+            queues_path = NetDevProfiling.queues_path.format(interface)
+            if not os.path.isdir(queues_path):
+                continue
+            for queue in sorted(os.listdir(queues_path)):
+                if not queue.startswith('tx-'):
+                    continue
+                queue_prefix = prefix + 'txq{}_'.format(queue[3:])
+                for (path, metric, is_counter) in [('tx_timeout', 'timeouts', True), ('byte_queue_limits/inflight', 'inflight_bytes', False)]:
+                    try:
+                        self.files.append((queue_prefix + metric, PersistentFile(os.path.join(queues_path, queue, path)), is_counter))
+                    except OSError:
+                        pass
+
+    def read_counters(self):
+        counters = {}
+        for l in self.netdev_file.read().decode().splitlines()[2:]:
+            (interface, values) = l.split(':', 1)
+            interface = interface.strip()
+            if interface not in self.interfaces:
+                continue
+            values = values.split()
+            prefix = 'net.{}.'.format(NetDevProfiling.key_name(interface))
+            for (i, metric) in NetDevProfiling.netdev_fields.items():
+                counters[prefix + metric] = int(values[i])
+        for f in self.tcp_files:
+            lines = f.read().decode().splitlines()
+            # counters come in pairs of lines, the names followed by the values
+            for (names, values) in zip(lines[0::2], lines[1::2]):
+                names = names.split()
+                tcp_counters = NetDevProfiling.tcp_counters.get(names[0])
+                if not tcp_counters:
+                    continue
+                values = values.split()
+                for counter in tcp_counters:
+                    if counter in names:
+                        counters['net.tcp.' + counter] = int(values[names.index(counter)])
+        for (interface, stats, selected) in self.ethtool:
+            values = stats.read()
+            for (i, key) in selected:
+                counters[key] = values[i]
+        gauges = {}
+        for (key, f, is_counter) in self.files:
+            if is_counter:
+                counters[key] = int(f.read())
+            else:
+                gauges[key] = int(f.read())
+        return (counters, gauges)
+
+    def sample(self, timestamp):
+        (counters, gauges) = self.read_counters()
+        with self.lock:
+            if self.last_timestamp is not None:
+                elapsed = (timestamp - self.last_timestamp) / 1000000000
+                for (key, value) in counters.items():
+                    last_value = self.last_counters.get(key)
+                    if last_value is not None:
+                        self.record(key, timestamp, (value - last_value) / elapsed)
+            for (key, value) in gauges.items():
+                self.record(key, timestamp, value)
+        self.last_counters = counters
+        self.last_timestamp = timestamp
+
+    def start(self):
+        if self.files is None:
+            self.open_files()
+        self.last_counters = {}
+        self.last_timestamp = None
+        super().start()
+
+    def close(self):
+        for (interface, stats, selected) in self.ethtool if self.files is not None else []:
+            stats.close()
+
+    def interrupt_sample(self):
+        pass
+
+    def zerosample(self, timestamp):
+        pass
+
+    def clear(self):
+        self.timeseries = {}
+
+class MemcachedStatsProfiling(EventProfiling):
+    """Polls the stats of a memcached server over a single persistent connection.
+
+    Every tick sends stats, plus stats slabs and stats conns if requested, and records 
+    the numeric values as mcstats.<stat>, mcstats.slab<id>.<stat>, mcstats.slabs.<stat> 
+    and mcstats.conn<fd>.<stat>. Stats that describe the current state, such as 
+    curr_connections, threads or bytes, are recorded as they are and every other stat 
+    is a counter recorded as a rate per second. When the server cannot be reached the 
+    tick is skipped and the connection is opened again on the next one.
+    """
+    name = 'mcstats'
+    gauges = set([
+        'pid', 'uptime', 'time', 'pointer_size', 'rusage_maxrss', 'max_connections', 
+        'curr_connections', 'connection_structures', 'reserved_fds', 'threads', 
+        'limit_maxbytes', 'bytes', 'curr_items', 'hash_power_level', 'hash_bytes', 
+        'hash_is_expanding', 'slab_reassign_running', 'lru_crawler_running', 
+        'malloc_fails', 'response_obj_bytes', 'read_buf_bytes', 'read_buf_bytes_free', 
+        'active_slabs', 'total_malloced', 'chunk_size', 'chunks_per_page', 'total_pages', 
+        'total_chunks', 'used_chunks', 'free_chunks', 'free_chunks_end', 'mem_requested', 
+        'secs_since_last_cmd',
+    ])
+
+    def __init__(self, sampling_period=1, host='localhost', port=11211, extra_stats=[], timeout=0.5):
+        super().__init__(sampling_period, sampling_length=0)
+        self.host = host
+        self.port = port
+        self.commands = [('stats', '')] + [('stats {}'.format(e), e) for e in extra_stats]
+        self.timeout = timeout
+        self.sock = None
+        self.poll_failed = False
+        self.last_counters = {}
+        self.last_timestamp = None
+        self.timeseries = {}
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        logging.info('Connected to memcached at {}:{}'.format(self.host, self.port))
+
+    def disconnect(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def request(self, command):
+        self.sock.sendall(command.encode() + b'\r\n')
+        reply = b''
+        while not (reply.endswith(b'END\r\n') or reply.endswith(b'ERROR\r\n')):
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError('memcached closed the connection')
+            reply += data
+        return reply
+
+    @staticmethod
+    def parse_stats(reply, group):
+        """Maps the key of every numeric stat of a reply to its value"""
+        stats = {}
+        for l in reply.decode().splitlines():
+            fields = l.split()
+            if len(fields) != 3 or fields[0] != 'STAT':
+                continue
+            try:
+                value = float(fields[2])
+            except ValueError:
+                continue
+            (prefix, _, name) = fields[1].rpartition(':')
+            if prefix:
+                # stats of a single slab class or connection, e.g. STAT 1:get_hits 5
+                key = 'mcstats.{}{}.{}'.format(group.rstrip('s'), prefix, name)
+            elif group:
+                key = 'mcstats.{}.{}'.format(group, name)
+            else:
+                key = 'mcstats.{}'.format(name)
+            stats[key] = (name, value)
+        return stats
+
+    def read_stats(self):
+        if not self.sock:
+            self.connect()
+        stats = {}
+        for (command, group) in self.commands:
+            stats.update(MemcachedStatsProfiling.parse_stats(self.request(command), group))
+        return stats
+
+    def sample(self, timestamp):
+        try:
+            stats = self.read_stats()
+        except OSError as e:
+            # only the first of consecutive failures is logged
+            if not self.poll_failed:
+                logging.info('Cannot poll memcached at {}:{}: {}'.format(self.host, self.port, e))
+            self.poll_failed = True
+            self.disconnect()
+            self.last_counters = {}
+            self.last_timestamp = None
+            return
+        self.poll_failed = False
+        counters = {}
+        with self.lock:
+            for (key, (name, value)) in stats.items():
+                if name in MemcachedStatsProfiling.gauges:
+                    self.record(key, timestamp, value)
+                else:
+                    counters[key] = value
+            if self.last_timestamp is not None:
+                elapsed = (timestamp - self.last_timestamp) / 1000000000
+                for (key, value) in counters.items():
+                    last_value = self.last_counters.get(key)
+                    # counters restart from zero when memcached is restarted
+                    if last_value is not None and value >= last_value:
+                        self.record(key, timestamp, (value - last_value) / elapsed)
+        self.last_counters = counters
+        self.last_timestamp = timestamp
+
+    def start(self):
+        self.last_counters = {}
+        self.last_timestamp = None
+        super().start()
+
+    def close(self):
+        self.disconnect()
+
+    def interrupt_sample(self):
+        pass
+
+    def zerosample(self, timestamp):
+        pass
+
+    def clear(self):
+        self.timeseries = {}
+
+class ThreadSchedProfiling(EventProfiling):
+    """Per-thread scheduling statistics of a process, such as the memcached workers"""
+    name = 'threads'
+    voluntary_cs_re = re.compile(rb'\nvoluntary_ctxt_switches:\s*(\d+)')
+    nonvoluntary_cs_re = re.compile(rb'\nnonvoluntary_ctxt_switches:\s*(\d+)')
+
+    def __init__(self, sampling_period=1, process_name='memcached'):
+        super().__init__(sampling_period, sampling_length=0)
+        self.process_name = process_name
+        self.files = {}
+        self.last_counters = {}
+        self.timeseries = {}
+
+    def find_pid(self):
+        result = subprocess.run(['pgrep', '-o', '-x', self.process_name], stdout=subprocess.PIPE)
+        pid = result.stdout.decode('utf-8').strip()
+        return int(pid) if pid else None
+
+    def open_files(self, pid):
+        self.files = {}
+        task_path = '/proc/{}/task'.format(pid)
+        for tid in sorted(os.listdir(task_path), key=int):
+            thread_path = os.path.join(task_path, tid)
+            try:
+                self.files[tid] = (
+                    PersistentFile(os.path.join(thread_path, 'schedstat')),
+                    PersistentFile(os.path.join(thread_path, 'status'), bufsize=4096),
+                    PersistentFile(os.path.join(thread_path, 'stat'), bufsize=1024))
+            except FileNotFoundError:
+                pass
+
+    def close_files(self):
+        for files in self.files.values():
+            for f in files:
+                f.close()
+        self.files = {}
+
+    def read_counters(self, files):
+        (schedstat, status, stat) = files
+        # schedstat: time on cpu (ns), time waiting on a runqueue (ns), timeslices
+        (cpu_time, runq_wait, _) = [int(v) for v in schedstat.read().split()]
+        status_data = status.read()
+        voluntary_cs = int(ThreadSchedProfiling.voluntary_cs_re.search(status_data).group(1))
+        nonvoluntary_cs = int(ThreadSchedProfiling.nonvoluntary_cs_re.search(status_data).group(1))
+        # the processor the thread last ran on is field 39 of stat, counting from 
+        # pid and comm which precede the last ')'
+        stat_data = stat.read()
+        cpu = int(stat_data[stat_data.rindex(b')')+2:].split()[36])
+        return (cpu_time, runq_wait, voluntary_cs, nonvoluntary_cs, cpu)
+
+    def sample(self, timestamp):
+        thread_counters = []
+        for tid, files in self.files.items():
+            try:
+                thread_counters.append((tid, self.read_counters(files)))
+            except (OSError, ValueError):
+                # the thread has exited
+                continue
+        with self.lock:
+            for (tid, counters) in thread_counters:
+                last = self.last_counters.get(tid)
+                self.last_counters[tid] = (timestamp, counters)
+                if not last:
+                    continue
+                (last_timestamp, last_counters) = last
+                interval = timestamp - last_timestamp
+                (cpu_time, runq_wait, voluntary_cs, nonvoluntary_cs, _) = [new - old for (new, old) in zip(counters, last_counters)]
+                prefix = '{}.{}'.format(self.process_name, tid)
+                self.record(prefix + '.cpu_util', timestamp, cpu_time / interval)
+                self.record(prefix + '.runq_delay', timestamp, runq_wait / interval)
+                self.record(prefix + '.voluntary_cs_rate', timestamp, voluntary_cs * 1000000000 / interval)
+                self.record(prefix + '.nonvoluntary_cs_rate', timestamp, nonvoluntary_cs * 1000000000 / interval)
+                self.record(prefix + '.cpu', timestamp, counters[4])
+
+    def start(self):
+        self.close_files()
+        self.last_counters = {}
+        pid = self.find_pid()
+        if pid:
+            self.open_files(pid)
+        else:
+            logging.info('No {} process to profile'.format(self.process_name))
+        super().start()
+
+    def interrupt_sample(self):
+        pass
+
+    def zerosample(self, timestamp):
+        pass
+
+    def clear(self):
+        self.timeseries = {}
 
 class StateProfiling(EventProfiling):
+    name = 'cpuidle'
     cpuidle_path = '/sys/devices/system/cpu/cpu0/cpuidle/'
+    metrics = ['usage', 'time']
+    min_sampling_period = 0.01
 
-    def __init__(self, sampling_period=0):
-        super().__init__(sampling_period)
+    def __init__(self, sampling_period=0, persistent=False):
+        if sampling_period and sampling_period < StateProfiling.min_sampling_period:
+            raise Exception('cpuidle sampling period must be at least {}s'.format(StateProfiling.min_sampling_period))
+        super().__init__(sampling_period, sampling_length=0)
         self.state_names = StateProfiling.power_state_names()
+        self.persistent = persistent
+        self.files = None
         self.timeseries = {}
 
     @staticmethod
@@ -225,17 +1552,51 @@ class StateProfiling(EventProfiling):
         output = open("/sys/devices/system/cpu/cpu{}/cpuidle/state{}/{}".format(cpu_id, state_id, metric)).read()
         return output.strip()
 
-    def sample_power_state_metric(self, metric, timestamp):
+    def open_files(self):
+        # Files are opened once and kept open for the lifetime of the profiler, 
+        # so each tick costs one pread per file instead of an exists/open/read/close sequence
+        self.files = []
+        for metric in StateProfiling.metrics:
+            for cpu_id in range(0, os.cpu_count()):
+                for state_id in range(0, len(self.state_names)):
+                    state_name = self.state_names[state_id]
+                    key = "CPU{}.{}.{}".format(cpu_id, state_name, metric)
+                    path = "/sys/devices/system/cpu/cpu{}/cpuidle/state{}/{}".format(cpu_id, state_id, metric)
+                    self.files.append((key, PersistentFile(path, bufsize=32)))
+
+    def read_power_state_metric(self, metric):
+        values = []
         for cpu_id in range(0, os.cpu_count()):
             for state_id in range(0, len(self.state_names)):
                 state_name = self.state_names[state_id]
                 key = "CPU{}.{}.{}".format(cpu_id, state_name, metric)
                 value = StateProfiling.power_state_metric(cpu_id, state_id, metric)
-                self.timeseries.setdefault(key, []).append((timestamp, value))
+                values.append((key, int(value)))
+        return values
+
+    def read_persistent(self):
+        return [(key, int(f.read())) for (key, f) in self.files]
 
     def sample(self, timestamp):
-        self.sample_power_state_metric('usage', timestamp)
-        self.sample_power_state_metric('time', timestamp)
+        # files are read before taking the lock, so reports only wait for the recording
+        if self.persistent:
+            values = self.read_persistent()
+        else:
+            values = []
+            for metric in StateProfiling.metrics:
+                values.extend(self.read_power_state_metric(metric))
+        with self.lock:
+            for (key, value) in values:
+                self.record(key, timestamp, value)
+
+    def start(self):
+        if self.persistent and self.files is None:
+            self.open_files()
+        super().start()
+
+    def is_counter(self, key):
+        # both the usage and time of every state are cumulative
+        return not key.startswith('profiler.')
 
     def interrupt_sample(self):
         pass
@@ -246,54 +1607,714 @@ class StateProfiling(EventProfiling):
     def clear(self):
         self.timeseries = {}
 
-    def report(self):
-        return self.timeseries
+class IdleTraceProfiling(EventProfiling):
+    """Traces the idle state transitions of every cpu with the power:cpu_idle tracepoint.
+
+    The tracepoint is enabled in a dedicated ftrace instance using the mono trace 
+    clock, so trace timestamps are on the same clock as every other sample and other 
+    ftrace users are left alone. A reader thread drains the instance's trace_pipe every 
+    read_interval seconds, rather than waking up on every event and so causing idle 
+    transitions itself, and records idletrace.cpuN.state with the state entered, or -1 
+    when the cpu leaves idle, so idle intervals are available as soon as profiling stops.
+    """
+    name = 'idletrace'
+    tracefs_paths = ['/sys/kernel/tracing', '/sys/kernel/debug/tracing']
+    instance_name = 'mcperf'
+    # e.g. <idle>-0 [003] d..1. 1234.567890: cpu_idle: state=1 cpu_id=3
+    event_re = re.compile(rb'([0-9]+)\.([0-9]+): cpu_idle: state=([0-9]+) cpu_id=([0-9]+)')
+    # the state of an exit from idle, (u32)-1
+    exit_state = 4294967295
+    event_rate = 1000
+
+    def __init__(self, sampling_period=0, cpus=None, buffer_size_kb=4096, read_interval=0.1):
+        super().__init__(sampling_period=0)
+        self.cpus = cpus
+        self.buffer_size_kb = buffer_size_kb
+        self.read_interval = read_interval
+        self.instance_path = None
+        self.thread = None
+        self.keys = {}
+        self.timeseries = {}
+
+    @staticmethod
+    def cpumask(cpus):
+        # cpumasks are written as comma-separated groups of 32 bits
+        mask = format(sum([1 << cpu for cpu in cpus]), 'x')
+        groups = []
+        while mask:
+            groups.insert(0, mask[-8:])
+            mask = mask[:-8]
+        return ','.join(groups)
+
+    def write(self, name, value):
+        with open(os.path.join(self.instance_path, name), 'w') as f:
+            f.write(value)
+
+    def open_instance(self):
+        tracefs_path = next((p for p in IdleTraceProfiling.tracefs_paths if os.path.isdir(os.path.join(p, 'instances'))), None)
+        if not tracefs_path:
+            raise FileNotFoundError('tracefs is not mounted')
+        self.instance_path = os.path.join(tracefs_path, 'instances', IdleTraceProfiling.instance_name)
+        if not os.path.isdir(self.instance_path):
+            os.mkdir(self.instance_path)
+        self.write('trace_clock', 'mono')
+        self.write('buffer_size_kb', str(self.buffer_size_kb))
+        if self.cpus is not None:
+            self.write('tracing_cpumask', IdleTraceProfiling.cpumask(self.cpus))
+
+    def parse(self, data):
+        """Records the events of the complete lines of data and returns the incomplete last line"""
+        end = data.rfind(b'\n') + 1
+        with self.lock:
+            for m in IdleTraceProfiling.event_re.finditer(data, 0, end):
+                (sec, frac, state, cpu) = m.groups()
+                timestamp = int(sec) * 1000000000 + int(frac) * 10 ** (9 - len(frac))
+                state = int(state)
+                key = self.keys.get(cpu)
+                if key is None:
+                    key = self.keys[cpu] = 'idletrace.cpu{}.state'.format(int(cpu))
+                self.record(key, timestamp, -1 if state == IdleTraceProfiling.exit_state else state)
+        return data[end:]
+
+    def reader_thread(self):
+        logging.info("Trace reader thread started")
+        pending = b''
+        while True:
+            (stopping, _, _) = select.select([self.stop_fd], [], [], self.read_interval)
+            start_ns = time.perf_counter_ns()
+            start_cpu_ns = time.thread_time_ns()
+            while True:
+                try:
+                    data = os.read(self.pipe_fd, 1048576)
+                except BlockingIOError:
+                    break
+                if not data:
+                    break
+                pending = self.parse(pending + data)
+            cpu_us = (time.thread_time_ns() - start_cpu_ns) / 1000
+            self.record_overhead(time.monotonic_ns(), (time.perf_counter_ns() - start_ns) / 1000, cpu_us)
+            # tracing is turned off before stopping, so the last drain leaves nothing behind
+            if stopping:
+                break
+        logging.info("Trace reader thread terminated")
 
-class ProfilingService:
-    def __init__(self, profilers):
-        self.profilers = profilers
-        
     def start(self):
+        self.clear()
+        try:
+            if not self.instance_path:
+                self.open_instance()
+            self.write('events/power/cpu_idle/enable', '1')
+            self.write('trace', '')
+            self.pipe_fd = os.open(os.path.join(self.instance_path, 'trace_pipe'), os.O_RDONLY | os.O_NONBLOCK)
+        except OSError as e:
+            logging.error('Cannot trace cpu_idle: {}'.format(e))
+            return
+        (self.stop_fd, self.stop_write_fd) = os.pipe()
+        self.thread = threading.Thread(target=IdleTraceProfiling.reader_thread, args=(self,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.write('tracing_on', '1')
+
+    def stop(self):
+        if not self.thread:
+            return
+        self.write('tracing_on', '0')
+        os.write(self.stop_write_fd, b'\0')
+        self.thread.join()
+        self.thread = None
+        for fd in [self.pipe_fd, self.stop_fd, self.stop_write_fd]:
+            os.close(fd)
+        self.write('events/power/cpu_idle/enable', '0')
+
+    def close(self):
+        if self.instance_path and os.path.isdir(self.instance_path):
+            os.rmdir(self.instance_path)
+        self.instance_path = None
+
+    def interrupt_sample(self):
+        pass
+
+    def zerosample(self, timestamp):
+        pass
+
+    def clear(self):
+        self.timeseries = {}
+
+class ProfilerGroup:
+    """Drives all periodic profilers from a single tick thread on the monotonic clock.
+
+    The thread wakes up on a grid of ticks spaced at the gcd of the profilers' sampling 
+    periods and samples the profilers that are due in the order they were given, so that 
+    all timeseries share the same tick boundaries. How late each sample was with respect 
+    to its deadline is recorded by the profiler as profiler.<name>.lateness_us.
+    """
+    def __init__(self, profilers, tick_priority=None, tick_nice=None):
+        self.profilers = profilers
+        # scheduling of the tick thread: a SCHED_FIFO priority or a nice value
+        self.tick_priority = tick_priority
+        self.tick_nice = tick_nice
+        self.periodic_profilers = [p for p in profilers if p.is_periodic()]
+        for p in self.periodic_profilers:
+            p.scheduled = True
+        self.terminate_thread = threading.Condition()
+        self.is_active = False
+
+    @staticmethod
+    def tick_period_ns(profilers):
+        # periods are converted to integer milliseconds so that their gcd is well defined
+        periods_ms = [int(round(p.sampling_period * 1000)) for p in profilers]
+        return functools.reduce(math.gcd, periods_ms) * 1000000
+
+    def prioritize(self):
+        """Applies the scheduling settings of the tick thread to the calling thread"""
+        try:
+            if self.tick_priority:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.tick_priority))
+            if self.tick_nice is not None:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.tick_nice)
+        except OSError as e:
+            logging.error('Cannot set the scheduling of the tick thread: {}'.format(e))
+
+    def tick_thread(self):
+        logging.info("Tick thread started")
+        self.prioritize()
+        profilers = self.periodic_profilers
+        tick_period_ns = ProfilerGroup.tick_period_ns(profilers)
+        period_ticks = [int(round(p.sampling_period * 1000000000 / tick_period_ns)) for p in profilers]
+        next_tick = [0] * len(profilers)
+        start_time_ns = self.start_time_ns
+        sleep_until_ns(start_time_ns)
+        tick = 0
+        self.terminate_thread.acquire()
+        while self.is_active:
+            self.terminate_thread.release()
+            for i, p in enumerate(profilers):
+                if next_tick[i] > tick:
+                    continue
+                deadline_ns = start_time_ns + next_tick[i] * tick_period_ns
+                timestamp = time.monotonic_ns()
+                try:
+                    p.timed_sample(timestamp, deadline_ns)
+                except Exception as e:
+                    # a failing sampler must not stop the ones sharing the tick
+                    logging.error('{} sample failed: {}'.format(p.name, e))
+                # samples whose deadline has already passed are skipped rather than taken back to back
+                while next_tick[i] <= tick:
+                    next_tick[i] += period_ticks[i]
+            tick = max(min(next_tick), (time.monotonic_ns() - start_time_ns) // tick_period_ns)
+            self.terminate_thread.acquire()
+            if self.is_active:
+                timeout_ns = start_time_ns + tick * tick_period_ns - time.monotonic_ns()
+                self.terminate_thread.wait(timeout=max(0, timeout_ns / 1000000000))
+        self.terminate_thread.release()
+        timestamp = time.monotonic_ns()
+        for p in profilers:
+            p.zerosample(timestamp)
+        logging.info("Tick thread terminated")
+
+    def start(self, start_time_ns=None):
+        # scheduled profilers only open their files here, so they are prepared first 
+        # and the rest start together with the first tick
+        for p in self.periodic_profilers:
+            p.start()
+        if start_time_ns is None:
+            start_time_ns = time.monotonic_ns()
+        self.start_time_ns = start_time_ns
+        if self.periodic_profilers:
+            self.is_active = True
+            self.thread = threading.Thread(target=ProfilerGroup.tick_thread, args=(self,))
+            self.thread.daemon = True
+            self.thread.start()
+        sleep_until_ns(start_time_ns)
         for p in self.profilers:
-            p.start()        
+            if not p.scheduled:
+                p.start()
 
     def stop(self):
+        if self.is_active:
+            self.terminate_thread.acquire()
+            self.is_active = False
+            self.terminate_thread.notify()
+            self.terminate_thread.release()
+            self.thread.join()
         for p in self.profilers:
-            p.stop()        
+            p.stop()
+
+class ProfilingService:
+    # bounds the size of a single report_chunk response (16 bytes per sample)
+    max_chunk_samples = 65536
+
+    # bounds the size of a single log_chunk response
+    max_chunk_records = 65536
+
+    def __init__(self, profilers, ring_seconds=None, ring_samples=None, config=None, spill=None, placement=None):
+        self.ring_seconds = ring_seconds
+        self.ring_samples = ring_samples
+        self.spill = spill
+        # where the daemon runs: housekeeping_cpus, tick_priority and tick_nice
+        self.placement = placement or {}
+        # the sampler entries the profilers were created from, updated by set()
+        self.config = config or []
+        self.set_profilers(profilers)
+        self.active = False
+        # serializes start, stop and set requests arriving on different server threads
+        self.control_lock = threading.Lock()
+        self.set_anchor()
+        self.start_times = None
+        self.stop_times = None
+
+    def set_profilers(self, profilers):
+        self.profilers = profilers
+        self.group = ProfilerGroup(profilers, self.placement.get('tick_priority'), self.placement.get('tick_nice'))
+        for p in profilers:
+            p.spill = self.spill
+        if self.ring_seconds or self.ring_samples:
+            for p in profilers:
+                p.capacity = ProfilingService.ring_capacity(p, self.ring_seconds, self.ring_samples)
+
+    @staticmethod
+    def ring_capacity(profiler, ring_seconds, ring_samples):
+        if ring_samples:
+            return ring_samples
+        if profiler.event_rate:
+            return math.ceil(ring_seconds * profiler.event_rate)
+        if not profiler.sampling_period:
+            # only the start and stop samples
+            return 2
+        return math.ceil(ring_seconds / profiler.sampling_period) + 1
+
+    def set_anchor(self):
+        # Samples are stamped with the monotonic clock; a single wall clock reading 
+        # taken together with a monotonic one maps them back to wall clock time
+        self.wall_anchor_ns = time.time_ns()
+        self.monotonic_anchor_ns = time.monotonic_ns()
+
+    def wall_clock_offset_ns(self):
+        return self.wall_anchor_ns - self.monotonic_anchor_ns
+
+    def start(self, start_at=None):
+        """Starts profiling, at wall clock time START_AT seconds if given.
+
+        Clients profiling several hosts pass the same START_AT to all of them so that 
+        their first samples line up, provided the hosts' clocks are synchronized.
+        """
+        with self.control_lock:
+            self.set_anchor()
+            start_time_ns = None
+            if start_at:
+                start_time_ns = int(start_at * 1000000000) - self.wall_clock_offset_ns()
+            self.start_times = os.times()
+            for p in self.profilers:
+                p.overhead_stats = {}
+            if self.spill:
+                self.spill.reset(self.wall_clock_offset_ns())
+            self.group.start(start_time_ns)
+            self.stop_times = None
+            self.active = True
+
+    def stop(self):
+        with self.control_lock:
+            self.group.stop()
+            if self.spill:
+                self.spill.flush()
+            self.stop_times = os.times()
+            self.active = False
 
     def report(self):
+        # XML-RPC integers are 32-bit, so timestamps are sent as wall clock seconds
+        offset_ns = self.wall_clock_offset_ns()
+        timeseries = {}
+        for (key, t) in self.copy_timeseries().items():
+            timeseries[key] = [((timestamp + offset_ns) / 1000000000, value) for (timestamp, value) in t]
+        return timeseries
+
+    def metrics(self):
+        """Maps every metric name to the lock that protects it and its timeseries"""
+        metrics = {}
+        for p in self.profilers:
+            with p.lock:
+                for (key, t) in p.timeseries.items():
+                    metrics[key] = (p.lock, t)
+        return metrics
+
+    def copy_timeseries(self):
+        # Samplers only wait for the copy; encoding happens outside the locks
         timeseries = {}
         for p in self.profilers:
-            t = p.report()
-            timeseries = {**timeseries, **t}
+            with p.lock:
+                for (key, t) in p.timeseries.items():
+                    timeseries[key] = t[:]
         return timeseries
 
-    def set(self, kv):
-        print(kv)
+    def get_placement(self):
+        """Describes where the daemon runs, to be kept with its reports"""
+        placement = dict(self.placement)
+        placement['affinity'] = sorted(os.sched_getaffinity(0))
+        return placement
+
+    def report_header(self):
+        return {
+            'wall_clock_offset_ns': str(self.wall_clock_offset_ns()),
+            'byteorder': sys.byteorder,
+            'timestamp_typecode': 'q',
+            'value_typecode': 'd',
+        }
+
+    @staticmethod
+    def pack_chunk(chunk):
+        return [xmlrpc.client.Binary(chunk.timestamps.tobytes()), xmlrpc.client.Binary(chunk.values.tobytes())]
+
+    def report_index(self):
+        """Describes the packed columns served by report_chunk"""
+        index = self.report_header()
+        index['metrics'] = []
+        for (key, (lock, t)) in self.metrics().items():
+            with lock:
+                index['metrics'].append([key, t.first_seq, t.next_seq(), t.overwritten])
+        return index
+
+    def snapshot(self, window_seconds):
+        """Describes the samples taken in the last window_seconds, to be fetched with report_chunk"""
+        index = self.report_header()
+        index['metrics'] = []
+        since_ns = time.monotonic_ns() - int(window_seconds * 1000000000)
+        for (key, (lock, t)) in self.metrics().items():
+            with lock:
+                index['metrics'].append([key, t.seq_at(since_ns), t.next_seq(), t.overwritten])
+        return index
+
+    def report_chunk(self, key, start, count):
+        """Returns up to count samples of a metric starting at sequence number start as packed column bytes"""
+        count = min(count, ProfilingService.max_chunk_samples)
+        (_, chunk) = self.read_metric(key, lambda t: t.since(start, count))
+        return ProfilingService.pack_chunk(chunk)
+
+    def read_metric(self, key, read):
+        """Applies read to the timeseries of a metric under its profiler's lock.
+
+        Returns the profiler recording the metric along with what read returned.
+        """
+        for p in self.profilers:
+            with p.lock:
+                t = p.timeseries.get(key)
+                if t is not None:
+                    return (p, read(t))
+        raise Exception('No such metric: {}'.format(key))
+
+    def report_aggregate(self, key, window_seconds, stats, start=0):
+        """Returns the samples of a metric from sequence number start aggregated into windows.
+
+        The reply maps every requested stat out of aggregate_stats to its packed 
+        columns, with one sample per window. Only counters have a rate.
+        """
+        (p, samples) = self.read_metric(key, lambda t: t.since(start, t.next_seq()))
+        window_ns = int(window_seconds * 1000000000)
+        aggregates = aggregate_timeseries(samples, window_ns, self.wall_clock_offset_ns(), stats, p.is_counter(key))
+        return {stat: ProfilingService.pack_chunk(t) for (stat, t) in aggregates.items()}
+
+    def log_names(self):
+        """Returns the metric names of the spill log by metric id"""
+        if not self.spill:
+            raise Exception('The profiler does not spill samples to disk')
+        return self.spill.names()
+
+    def log_chunk(self, start, count):
+        """Returns up to count spill log records starting at record number start.
+
+        Records are packed with SpillLog.record_format and hold wall clock timestamps. 
+        The log holds the samples of the last run, even one of an earlier profiler 
+        process, and samples reach it within a flush interval of being taken.
+        """
+        if not self.spill:
+            raise Exception('The profiler does not spill samples to disk')
+        count = min(count, ProfilingService.max_chunk_records)
+        return xmlrpc.client.Binary(self.spill.read(start, count))
+
+    def report_since(self, cursor, release=False):
+        """Returns the samples appended after a cursor.
+
+        The cursor maps metric names to the sequence number of the first sample the 
+        client has not received yet. Metrics missing from the cursor are sent from 
+        their first retained sample. With release, the samples before the cursor are 
+        dropped from memory, so they are no longer available to any other report.
+        """
+        reply = self.report_header()
+        reply['active'] = self.active
+        reply['more'] = False
+        reply['cursor'] = {}
+        reply['metrics'] = {}
+        for (key, (lock, t)) in self.metrics().items():
+            seq = cursor.get(key, 0)
+            with lock:
+                if seq > t.next_seq():
+                    # the timeseries was cleared by a new start()
+                    seq = 0
+                if release:
+                    t.release(seq)
+                chunk = t.since(seq, ProfilingService.max_chunk_samples)
+                more = chunk.next_seq() < t.next_seq()
+            reply['cursor'][key] = chunk.next_seq()
+            if len(chunk):
+                reply['metrics'][key] = ProfilingService.pack_chunk(chunk)
+            if more:
+                reply['more'] = True
+        return reply
+
+    def overhead(self):
+        """Summarizes the cost, cpu time and lateness of every sample since start, per profiler.
+
+        The summary covers the whole run, even once followers or ring buffers have 
+        dropped the samples themselves.
+
+        The process entry adds up the cpu time of the daemon and of the child 
+        processes it waited for since start, which includes forking samplers.
+        """
+        if not self.start_times:
+            return {}
+        summary = {}
+        for p in self.profilers:
+            with p.lock:
+                summary[p.name] = {metric: stats.summary() for (metric, stats) in p.overhead_stats.items()}
+        start_times = self.start_times
+        end_times = self.stop_times or os.times()
+        summary['process'] = {
+            'elapsed_s': end_times.elapsed - start_times.elapsed,
+            'cpu_s': (end_times.user + end_times.system) - (start_times.user + start_times.system),
+            'children_cpu_s': (end_times.children_user + end_times.children_system) - 
+                (start_times.children_user + start_times.children_system),
+        }
+        return summary
+
+    def set(self, entries):
+        """Reconfigures the samplers between runs and returns the new configuration.
+
+        Every entry updates the entry of the sampler with the same name, or adds one. 
+        Samplers whose entry changed are created anew and the others are kept as they are.
+        """
+        with self.control_lock:
+            if self.active:
+                raise Exception('Samplers cannot be reconfigured while profiling')
+            config = merge_profiler_config(self.config, entries)
+            old_entries = {entry['name']: entry for entry in self.config}
+            old_profilers = {p.name: p for p in self.profilers}
+            profilers = []
+            for entry in config:
+                if not entry.get('enabled', True):
+                    continue
+                p = old_profilers.get(entry['name'])
+                if p is None or entry != old_entries.get(entry['name']):
+                    p = create_profiler(entry)
+                profilers.append(p)
+            for p in self.profilers:
+                if p not in profilers:
+                    p.close()
+            self.config = config
+            self.set_profilers(profilers)
+            return config
+
+class ThreadingXMLRPCServer(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+    """Serves each request on its own thread, so a long report never delays start/stop requests"""
+    daemon_threads = True
 
-def server(port):
+# sampler name -> profiler class, for the entries of a profiler configuration
+sampler_registry = {p.name: p for p in [
+    RaplCountersProfiling, PerfEventProfiling, MpstatProfiling, ProcStatProfiling, 
+    CpuFreqProfiling, InterruptsProfiling, NetDevProfiling, MemcachedStatsProfiling, 
+    ThreadSchedProfiling, StateProfiling, IdleTraceProfiling,
+]}
 
-    rapl_profiling = RaplCountersProfiling(sampling_period=0)
-    perf_event_profiling = PerfEventProfiling(sampling_period=30,sampling_length=30)
-    mpstat_profiling = MpstatProfiling()
-    state_profiling = StateProfiling(sampling_period=0)
-    profiling_service = ProfilingService([rapl_profiling, perf_event_profiling, mpstat_profiling, state_profiling])
+def create_profiler(entry):
+    """Creates the sampler of a configuration entry.
+
+    An entry has a name and optionally enabled, period (the sampling period in 
+    seconds), cpus (e.g. 0-9) and options (further constructor arguments). Samplers 
+    outside this file are given as class: module:Class and are only imported when 
+    an entry enables them.
+    """
+    if 'class' in entry:
+        (module_name, class_name) = entry['class'].split(':')
+        cls = getattr(importlib.import_module(module_name), class_name)
+    elif entry['name'] in sampler_registry:
+        cls = sampler_registry[entry['name']]
+    else:
+        raise Exception('Unknown sampler {}'.format(entry['name']))
+    kwargs = dict(entry.get('options') or {})
+    if 'period' in entry:
+        kwargs['sampling_period'] = entry['period']
+    if entry.get('cpus') is not None:
+        kwargs['cpus'] = parse_cpu_list(str(entry['cpus']))
+    return cls(**kwargs)
+
+def create_profilers(config):
+    return [create_profiler(entry) for entry in config if entry.get('enabled', True)]
+
+def merge_profiler_config(config, entries):
+    """Returns a copy of config with every entry of entries merged into the entry of the same name"""
+    merged = [dict(entry) for entry in config]
+    for entry in entries:
+        old_entry = next((e for e in merged if e['name'] == entry['name']), None)
+        if old_entry is None:
+            merged.append(dict(entry))
+            continue
+        options = dict(old_entry.get('options') or {})
+        options.update(entry.get('options') or {})
+        old_entry.update(entry)
+        if options:
+            old_entry['options'] = options
+    return merged
+
+def load_profiler_config(path):
+    # PyYAML is only needed by daemons configured from a file
+    import yaml
+    with open(path, 'r') as f:
+        return yaml.safe_load(f)
+
+def profiler_config_from_args(args):
+    """Translates the sampler command-line options to configuration entries"""
+    config = [
+        {'name': 'rapl', 'period': args.rapl_period},
+        {'name': 'perf', 'enabled': bool(args.perf_period), 'period': args.perf_period, 'options': {'streaming': True}},
+        {'name': 'mpstat', 'enabled': args.cpu_util in ['mpstat', 'both']},
+        {'name': 'procstat', 'enabled': args.cpu_util in ['procstat', 'both'], 
+            'period': args.cpu_util_period, 'cpus': args.cpu_util_cpus},
+        {'name': 'cpuidle', 'period': args.cpuidle_period, 'options': {'persistent': True}},
+        {'name': 'cpufreq', 'enabled': bool(args.cpufreq_period), 
+            'period': args.cpufreq_period, 'cpus': args.cpufreq_cpus},
+        {'name': 'irq', 'enabled': bool(args.irq_period), 'period': args.irq_period, 'cpus': args.irq_cpus, 
+            'options': {'irq_regex': args.irq_regex, 'softirq_regex': args.softirq_regex}},
+        {'name': 'net', 'enabled': bool(args.net_period), 'period': args.net_period, 
+            'options': {'interface_regex': args.net_regex}},
+        {'name': 'mcstats', 'enabled': bool(args.mcstats_period), 'period': args.mcstats_period, 
+            'options': {
+                'host': args.mcstats_server.rsplit(':', 1)[0], 
+                'port': int(args.mcstats_server.rsplit(':', 1)[1]), 
+                'extra_stats': args.mcstats_extra.split(',') if args.mcstats_extra else []}},
+        {'name': 'threads', 'enabled': bool(args.threads_period), 'period': args.threads_period, 
+            'options': {'process_name': args.threads_process}},
+        {'name': 'idletrace', 'enabled': args.idle_trace},
+    ]
+    return config
+
+def server(args):
+    if args.config:
+        config = load_profiler_config(args.config)
+    else:
+        config = profiler_config_from_args(args)
+    placement = {}
+    if args.housekeeping_cpus:
+        placement['housekeeping_cpus'] = parse_cpu_list(args.housekeeping_cpus)
+        pin_threads(placement['housekeeping_cpus'])
+    if args.tick_priority:
+        placement['tick_priority'] = args.tick_priority
+    if args.tick_nice is not None:
+        placement['tick_nice'] = args.tick_nice
+    profilers = create_profilers(config)
+    spill = None
+    if args.spill_dir:
+        spill = SpillLog(args.spill_dir)
+    profiling_service = ProfilingService(profilers, ring_seconds=args.ring_seconds, ring_samples=args.ring_samples, config=config, spill=spill, placement=placement)
     hostname = socket.gethostname().split('.')[0]
-    server = SimpleXMLRPCServer((hostname, port), allow_none=True)
+    server = ThreadingXMLRPCServer((hostname, args.port), allow_none=True)
     server.register_instance(profiling_service)
-    logging.info("Listening on port {}...".format(port))
+    def terminate(signum, frame):
+        # kill_profiler sends SIGTERM; stopping first ends perf and tracing, which 
+        # would otherwise outlive the daemon on the measured node
+        logging.info("Terminating...")
+        with profiling_service.control_lock:
+            if profiling_service.active:
+                profiling_service.group.stop()
+                profiling_service.active = False
+            for p in profiling_service.profilers:
+                p.close()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, terminate)
+    logging.info("Listening on port {}...".format(args.port))
     server.serve_forever()
 
+def inventory_hosts(inventory, groups=['memcached', 'agents']):
+    """Returns the hosts of the given groups of an Ansible inventory file"""
+    config = configparser.ConfigParser(allow_no_value=True)
+    config.read(inventory)
+    hosts = []
+    for group in groups:
+        if group not in config:
+            raise Exception('Inventory {} has no group {}'.format(inventory, group))
+        hosts.extend([host for host in config[group] if host not in hosts])
+    return hosts
+
+class ProfilerClients:
+    """Issues requests to the profilers of several hosts in parallel.
+
+    Every request runs on its own thread with its own ServerProxy, since proxies 
+    cannot be shared between threads.
+    """
+    def __init__(self, hosts, port=8000):
+        self.hosts = hosts
+        self.port = port
+
+    def call(self, func):
+        """Calls FUNC(host, proxy) for every host and returns the results by host"""
+        def call_host(host):
+            with xmlrpc.client.ServerProxy("http://{}:{}/".format(host, self.port)) as proxy:
+                return func(host, proxy)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.hosts)) as executor:
+            futures = {host: executor.submit(call_host, host) for host in self.hosts}
+            return {host: future.result() for (host, future) in futures.items()}
+
+    def start(self, start_delay=1):
+        # all profilers start at the same wall clock time, far enough in the future 
+        # for the start request to reach every host
+        start_at = time.time() + start_delay
+        self.call(lambda host, proxy: proxy.start(start_at))
+
+    def stop(self):
+        self.call(lambda host, proxy: proxy.stop())
+
+    def report(self, directories, chunk_samples=ProfilingService.max_chunk_samples, window=None, packed=False, aggregate=None, raw=None, stats=aggregate_stats):
+        """Writes the report of every host to directories[host]
+
+        With aggregate, metrics are aggregated on the hosts into windows of AGGREGATE 
+        seconds, except for the ones matching regular expression RAW.
+        """
+        self.call(lambda host, proxy: ReportAction.write_stream(proxy, directories[host], chunk_samples, window, packed, aggregate, raw, stats))
+
+    def report_log(self, directories, packed=False):
+        """Writes the spill log of every host to directories[host]"""
+        self.call(lambda host, proxy: ReportAction.write_log(proxy, directories[host], packed))
+
+    def follow(self, directories, interval=1, packed=False):
+        """Appends the samples of every host to directories[host] until profiling stops"""
+        self.call(lambda host, proxy: ReportAction.follow(proxy, directories[host], interval, packed))
+
+    def report_xml(self):
+        return self.call(lambda host, proxy: proxy.report())
+
+    def placement(self):
+        return self.call(lambda host, proxy: proxy.get_placement())
+
+    def overhead(self):
+        return self.call(lambda host, proxy: proxy.overhead())
+
+    def set(self, entries):
+        return self.call(lambda host, proxy: proxy.set(entries))
+
+def client_hosts(args):
+    if args.inventory:
+        return inventory_hosts(args.inventory, args.groups.split(','))
+    return [args.hostname]
+
 class StartAction:
     @staticmethod
     def add_parser(subparsers):
         parser = subparsers.add_parser('start', help = "Start profiling")
         parser.set_defaults(func=StartAction.action)
+        parser.add_argument(
+                    "--start-delay", dest='start_delay', type=float, default=1,
+                    help="seconds from now at which all profilers start sampling")
 
     @staticmethod
     def action(args):
-        with xmlrpc.client.ServerProxy("http://{}:{}/".format(args.hostname, args.port)) as proxy:
-            proxy.start()
+        ProfilerClients(client_hosts(args), args.port).start(args.start_delay)
 
 class StopAction:
     @staticmethod
@@ -303,10 +2324,55 @@ class StopAction:
 
     @staticmethod
     def action(args):
-        with xmlrpc.client.ServerProxy("http://{}:{}/".format(args.hostname, args.port)) as proxy:
-            proxy.stop()
+        ProfilerClients(client_hosts(args), args.port).stop()
+
+class PackedReport:
+    """Collects the samples of a report and writes them to a single columnar file.
+
+    The file holds a magic string, the length of the index as an 8-byte little 
+    endian integer, the index as JSON, and then the timestamps ('q', wall clock ns) 
+    followed by the values ('d') of every metric. The index lists the name, sample 
+    count and offset of every metric, with offsets counted from the end of the index.
+    """
+    file_name = 'report.bin'
+    magic = b'MCPROF1\n'
+
+    def __init__(self):
+        self.metrics = {}
+
+    def append(self, metric_name, timestamp, value):
+        columns = self.metrics.get(metric_name)
+        if columns is None:
+            columns = self.metrics[metric_name] = (array.array('q'), array.array('d'))
+        columns[0].append(timestamp)
+        columns[1].append(value)
+
+    def write(self, directory):
+        index = {
+            'byteorder': sys.byteorder,
+            'timestamp_typecode': 'q',
+            'value_typecode': 'd',
+            'metrics': [],
+        }
+        offset = 0
+        for (metric_name, (timestamps, values)) in self.metrics.items():
+            index['metrics'].append({'name': metric_name, 'count': len(timestamps), 'offset': offset})
+            offset += len(timestamps) * timestamps.itemsize + len(values) * values.itemsize
+        index_bytes = json.dumps(index).encode('utf-8')
+        path = os.path.join(directory, PackedReport.file_name)
+        # a report interrupted while being written never replaces a complete one
+        with open(path + '.tmp', 'wb') as f:
+            f.write(PackedReport.magic)
+            f.write(struct.pack('<Q', len(index_bytes)))
+            f.write(index_bytes)
+            for (timestamps, values) in self.metrics.values():
+                timestamps.tofile(f)
+                values.tofile(f)
+        os.replace(path + '.tmp', path)
 
 class ReportAction:
+    placement_file_name = 'placement.json'
+
     @staticmethod
     def add_parser(subparsers):
         parser = subparsers.add_parser('report', help = "Report profiling")
@@ -314,41 +2380,302 @@ class ReportAction:
         parser.add_argument(
                     "-d", "--directory", dest='directory',
                     help="directory where to output results")
+        parser.add_argument(
+                    "--chunk-samples", dest='chunk_samples', type=int, default=ProfilingService.max_chunk_samples,
+                    help="samples transferred per binary report chunk")
+        parser.add_argument(
+                    "--xml", dest='xml', action='store_true',
+                    help="transfer the report as a single XML-RPC response instead of binary chunks")
+        parser.add_argument(
+                    "-f", "--follow", dest='follow', action='store_true',
+                    help="poll for new samples while profiling is active and append them to the output directory")
+        parser.add_argument(
+                    "-i", "--interval", dest='interval', type=float, default=1,
+                    help="polling interval in seconds in follow mode")
+        parser.add_argument(
+                    "-w", "--window", dest='window', type=float,
+                    help="only report the samples of the last WINDOW seconds")
+        parser.add_argument(
+                    "--format", dest='format', choices=['text', 'packed'], default='text',
+                    help="write one text file per metric or a single packed {} file".format(PackedReport.file_name))
+        parser.add_argument(
+                    "--from-log", dest='from_log', action='store_true',
+                    help="report the samples of the spill log, which outlives a restart of the profiler")
+        parser.add_argument(
+                    "-a", "--aggregate", dest='aggregate', type=float,
+                    help="aggregate every metric on the server into windows of AGGREGATE seconds, written as METRIC@STAT")
+        parser.add_argument(
+                    "--raw", dest='raw',
+                    help="regular expression of the metrics transferred raw when aggregating")
+        parser.add_argument(
+                    "--stats", dest='stats', default=','.join(aggregate_stats),
+                    help="comma-separated aggregates to report out of {}".format(','.join(aggregate_stats)))
+
+    @staticmethod
+    def directories(args, hosts):
+        """Reports of an inventory go to per-host subdirectories of the output directory"""
+        if not args.inventory:
+            return {args.hostname: args.directory}
+        return {host: os.path.join(args.directory, host) for host in hosts}
 
     @staticmethod
     def action(args):
-        with xmlrpc.client.ServerProxy("http://{}:{}/".format(args.hostname, args.port)) as proxy:
-            stats = proxy.report()
-            if args.directory:
-                ReportAction.write_output(stats, args.directory)
-            else:
-                print(stats)
+        hosts = client_hosts(args)
+        clients = ProfilerClients(hosts, args.port)
+        packed = args.format == 'packed'
+        if args.from_log:
+            if not args.directory:
+                raise Exception('Reporting the spill log requires an output directory')
+            clients.report_log(ReportAction.directories(args, hosts), packed)
+            return
+        if args.follow:
+            if not args.directory:
+                raise Exception('Follow mode requires an output directory')
+            clients.follow(ReportAction.directories(args, hosts), args.interval, packed)
+            return
+        if args.directory and not args.xml:
+            clients.report(ReportAction.directories(args, hosts), args.chunk_samples, args.window, packed, args.aggregate, args.raw, args.stats.split(','))
+            return
+        if args.aggregate:
+            raise Exception('Aggregation requires an output directory and binary chunks')
+        stats = clients.report_xml()
+        if args.directory:
+            placements = clients.placement()
+            for (host, directory) in ReportAction.directories(args, hosts).items():
+                ReportAction.write_output(stats[host], directory, packed)
+                ReportAction.write_placement(directory, placements[host])
+        elif args.inventory:
+            print(stats)
+        else:
+            print(stats[args.hostname])
+
+    @staticmethod
+    def unpack_chunk(header, packed_chunk):
+        """Decodes packed column bytes into wall clock (timestamp, value) pairs"""
+        (timestamps_bin, values_bin) = packed_chunk
+        timestamps = array.array(header['timestamp_typecode'], timestamps_bin.data)
+        values = array.array(header['value_typecode'], values_bin.data)
+        if header['byteorder'] != sys.byteorder:
+            timestamps.byteswap()
+            values.byteswap()
+        offset_ns = int(header['wall_clock_offset_ns'])
+        return [(timestamp + offset_ns, value) for (timestamp, value) in zip(timestamps, values)]
+
+    @staticmethod
+    def read_chunks(proxy, index, key, first_seq, next_seq, chunk_samples):
+        """Yields the samples of a metric by fetching it from the server chunk by chunk"""
+        start = first_seq
+        while start < next_seq:
+            samples = ReportAction.unpack_chunk(index, proxy.report_chunk(key, start, chunk_samples))
+            if not samples:
+                break
+            start += len(samples)
+            yield from samples
 
     @staticmethod
-    def write_output(stats, directory):
+    def write_placement(directory, placement):
+        """Keeps the placement of the profiler with the samples it took"""
+        with open(os.path.join(directory, ReportAction.placement_file_name), 'w') as f:
+            json.dump(placement, f, indent=2)
+
+    @staticmethod
+    def metric_file_path(directory, metric_name):
+        metric_file_name = metric_name.replace('/', '-')
+        return os.path.join(directory, metric_file_name)
+
+    @staticmethod
+    def write_samples(directory, report, metric_name, samples):
+        """Adds the samples of a metric to REPORT, or writes them to their own file if it is None"""
+        if report is not None:
+            for (timestamp, value) in samples:
+                report.append(metric_name, timestamp, value)
+            return
+        with open(ReportAction.metric_file_path(directory, metric_name), 'w') as mf:
+            mf.write(metric_name + '\n')
+            for (timestamp, value) in samples:
+                mf.write('{},{}\n'.format(timestamp, value))
+
+    @staticmethod
+    def write_stream(proxy, directory, chunk_samples, window=None, packed=False, aggregate=None, raw=None, stats=aggregate_stats):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if window:
+            index = proxy.snapshot(window)
+        else:
+            index = proxy.report_index()
+        ReportAction.write_placement(directory, proxy.get_placement())
+        report = PackedReport() if packed else None
+        for (metric_name, first_seq, next_seq, overwritten) in index['metrics']:
+            if overwritten:
+                logging.warning('{}: {} samples were overwritten, the report only covers the last ones'.format(metric_name, overwritten))
+            if aggregate and not (raw and re.search(raw, metric_name)):
+                aggregates = proxy.report_aggregate(metric_name, aggregate, stats, first_seq)
+                for (stat, packed_chunk) in aggregates.items():
+                    samples = ReportAction.unpack_chunk(index, packed_chunk)
+                    ReportAction.write_samples(directory, report, '{}@{}'.format(metric_name, stat), samples)
+                continue
+            samples = ReportAction.read_chunks(proxy, index, metric_name, first_seq, next_seq, chunk_samples)
+            ReportAction.write_samples(directory, report, metric_name, samples)
+        if packed:
+            report.write(directory)
+
+    @staticmethod
+    def write_log(proxy, directory, packed=False):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        names = proxy.log_names()
+        ReportAction.write_placement(directory, proxy.get_placement())
+        report = PackedReport()
+        start = 0
+        while True:
+            chunk = proxy.log_chunk(start, ProfilingService.max_chunk_records).data
+            if not chunk:
+                break
+            for (metric_id, timestamp, value) in SpillLog.record_format.iter_unpack(chunk):
+                if metric_id >= len(names):
+                    # the metric first appeared after the names were fetched
+                    names = proxy.log_names()
+                report.append(names[metric_id], timestamp, value)
+            start += len(chunk) // SpillLog.record_format.size
+        if packed:
+            report.write(directory)
+            return
+        for (metric_name, (timestamps, values)) in report.metrics.items():
+            ReportAction.write_samples(directory, None, metric_name, zip(timestamps, values))
+
+    @staticmethod
+    def follow(proxy, directory, interval, packed=False):
+        """Appends samples to the metric files as they are produced until profiling stops.
+
+        With packed, the metric files are consolidated into a packed report once 
+        profiling stops; until then they keep whatever was received so far. The 
+        daemon frees the samples once they are received, so other reports of the 
+        run only get the samples taken since the last poll.
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        metric_files = {}
+        cursor = {}
+        report = PackedReport()
+        ReportAction.write_placement(directory, proxy.get_placement())
+        try:
+            while True:
+                # the follower keeps everything it received, so the daemon can free it
+                reply = proxy.report_since(cursor, True)
+                for (metric_name, packed_chunk) in reply['metrics'].items():
+                    mf = metric_files.get(metric_name)
+                    if not mf:
+                        mf = metric_files[metric_name] = open(ReportAction.metric_file_path(directory, metric_name), 'w')
+                        mf.write(metric_name + '\n')
+                    for (timestamp, value) in ReportAction.unpack_chunk(reply, packed_chunk):
+                        mf.write('{},{}\n'.format(timestamp, value))
+                        if packed:
+                            report.append(metric_name, timestamp, value)
+                cursor = reply['cursor']
+                if reply['more']:
+                    continue
+                if not reply['active']:
+                    break
+                time.sleep(interval)
+        finally:
+            for mf in metric_files.values():
+                mf.close()
+        if packed:
+            report.write(directory)
+            for metric_name in metric_files:
+                os.remove(ReportAction.metric_file_path(directory, metric_name))
+
+    @staticmethod
+    def write_output(stats, directory, packed=False):
         if not os.path.exists(directory):
             os.makedirs(directory)        
+        if packed:
+            report = PackedReport()
+            for metric_name,timeseries in stats.items():
+                for (timestamp, value) in timeseries:
+                    report.append(metric_name, int(round(timestamp * 1000000000)), value)
+            report.write(directory)
+            return
         for metric_name,timeseries in stats.items():
             metric_file_name = metric_name.replace('/', '-')
             metric_file_path = os.path.join(directory, metric_file_name)
             with open(metric_file_path, 'w') as mf:
                 mf.write(metric_name + '\n')
-                for val in timeseries:
-                    mf.write(','.join(val) + '\n')
+                for (timestamp, value) in timeseries:
+                    mf.write('{},{}\n'.format(int(round(timestamp * 1000000000)), value))
+
+class OverheadAction:
+    @staticmethod
+    def add_parser(subparsers):
+        parser = subparsers.add_parser('overhead', help = "Report profiler overhead")
+        parser.set_defaults(func=OverheadAction.action)
+
+    @staticmethod
+    def action(args):
+        overhead = ProfilerClients(client_hosts(args), args.port).overhead()
+        for (host, summary) in overhead.items():
+            print(host)
+            for (name, metrics) in summary.items():
+                print('  {}: {}'.format(name, metrics))
 
 class SetAction:
     @staticmethod
     def add_parser(subparsers):
-        parser = subparsers.add_parser('set', help = "Set sysfs")
+        parser = subparsers.add_parser('set', help = "Reconfigure samplers between runs")
         parser.set_defaults(func=SetAction.action)
-        parser.add_argument('-c', dest='command')
-        parser.add_argument('rest', nargs=argparse.REMAINDER)
+        parser.add_argument(
+                    "-c", "--config", dest='config',
+                    help="configuration file whose entries are merged into the samplers' configuration")
+        parser.add_argument(
+                    'assignments', nargs='*', metavar='SAMPLER.FIELD=VALUE',
+                    help="e.g. rapl.period=0.5 perf.enabled=false procstat.cpus=0-9 mcstats.port=11212")
+
+    @staticmethod
+    def parse_value(value):
+        if value.lower() in ['true', 'false']:
+            return value.lower() == 'true'
+        for datatype in [int, float]:
+            try:
+                return datatype(value)
+            except ValueError:
+                pass
+        return value
+
+    @staticmethod
+    def is_list_option(name, field):
+        """Tells whether option FIELD of sampler NAME defaults to a list"""
+        sampler = sampler_registry.get(name)
+        if sampler is None:
+            return False
+        parameter = inspect.signature(sampler.__init__).parameters.get(field)
+        return parameter is not None and isinstance(parameter.default, list)
+
+    @staticmethod
+    def parse_assignment(assignment):
+        """Turns SAMPLER.FIELD=VALUE into a configuration entry, FIELD being an option unless it is enabled, period or cpus.
+
+        The value of an option that takes a list is a comma-separated list, e.g. 
+        mcstats.extra_stats=slabs,conns.
+        """
+        (key, value) = assignment.split('=', 1)
+        (name, field) = key.split('.', 1)
+        if field in ['enabled', 'period', 'cpus']:
+            return {'name': name, field: SetAction.parse_value(value)}
+        if SetAction.is_list_option(name, field):
+            value = [SetAction.parse_value(v) for v in value.split(',') if v]
+        else:
+            value = SetAction.parse_value(value)
+        return {'name': name, 'options': {field: value}}
 
     @staticmethod
     def action(args):
-        print(args)
-        with xmlrpc.client.ServerProxy("http://{}:{}/".format(args.hostname, args.port)) as proxy:
-            proxy.set(args.rest)
+        entries = load_profiler_config(args.config) if args.config else []
+        entries += [SetAction.parse_assignment(a) for a in args.assignments]
+        configs = ProfilerClients(client_hosts(args), args.port).set(entries)
+        for (host, config) in configs.items():
+            print(host)
+            for entry in config:
+                print('  {}'.format(entry))
 
 def parse_args():
     """Configures and parses command-line arguments"""
@@ -360,15 +2687,103 @@ def parse_args():
     parser.add_argument(
         "-n", "--hostname", dest='hostname',
         help="profiler server hostname")
+    parser.add_argument(
+        "-H", "--inventory", dest='inventory',
+        help="inventory file listing the profiler server hosts, e.g. hosts")
+    parser.add_argument(
+        "--groups", dest='groups', default='memcached,agents',
+        help="comma-separated inventory groups to profile")
     parser.add_argument(
         "-p", "--port", dest='port', type=int, default=8000,
         help="profiler server port")
+    parser.add_argument(
+        "--config", dest='config',
+        help="sampler configuration file, e.g. profiler_config.yml (replaces the sampler options below)")
+    parser.add_argument(
+        "--cpuidle-period", dest='cpuidle_period', type=float, default=0,
+        help="cpuidle sampling period in seconds (0 samples only at start and stop, minimum 0.01)")
+    parser.add_argument(
+        "--perf-period", dest='perf_period', type=float, default=0.1,
+        help="perf stat interval in seconds of the streaming perf energy counters (0 disables perf)")
+    parser.add_argument(
+        "--rapl-period", dest='rapl_period', type=float, default=1,
+        help="RAPL energy sampling period in seconds (0 samples only at start and stop)")
+    parser.add_argument(
+        "--cpu-util", dest='cpu_util', choices=['mpstat', 'procstat', 'both'], default='procstat',
+        help="cpu utilization sampler")
+    parser.add_argument(
+        "--cpu-util-period", dest='cpu_util_period', type=float, default=1,
+        help="/proc/stat sampling period in seconds")
+    parser.add_argument(
+        "--cpu-util-cpus", dest='cpu_util_cpus',
+        help="cpus to report /proc/stat utilization for, e.g. 0-9 (default: all)")
+    parser.add_argument(
+        "--cpufreq-period", dest='cpufreq_period', type=float, default=0,
+        help="effective cpu frequency sampling period in seconds (default 0 disables it); "
+             "reading the MSRs of a cpu interrupts it, so exclude the measured cpus with --cpufreq-cpus")
+    parser.add_argument(
+        "--cpufreq-cpus", dest='cpufreq_cpus',
+        help="cpus to report the effective frequency for, e.g. 0-9 (default: all)")
+    parser.add_argument(
+        "--irq-period", dest='irq_period', type=float, default=1,
+        help="interrupt and softirq rate sampling period in seconds (0 disables it)")
+    parser.add_argument(
+        "--irq-regex", dest='irq_regex',
+        help="only sample interrupts whose device name matches this regex, e.g. 'mlx5|eno1' (default: all)")
+    parser.add_argument(
+        "--softirq-regex", dest='softirq_regex',
+        help="only sample softirqs whose name matches this regex, e.g. 'NET_RX|NET_TX' (default: all)")
+    parser.add_argument(
+        "--irq-cpus", dest='irq_cpus',
+        help="cpus to report interrupt rates for, e.g. 0-9 (default: all)")
+    parser.add_argument(
+        "--net-period", dest='net_period', type=float, default=1,
+        help="network interface and TCP counter sampling period in seconds (0 disables it)")
+    parser.add_argument(
+        "--net-regex", dest='net_regex',
+        help="only sample network interfaces whose name matches this regex, e.g. 'eno1|enp' (default: all)")
+    parser.add_argument(
+        "--mcstats-period", dest='mcstats_period', type=float, default=1,
+        help="memcached stats polling period in seconds (0 disables it)")
+    parser.add_argument(
+        "--mcstats-server", dest='mcstats_server', default='localhost:11211',
+        help="memcached server to poll as host:port")
+    parser.add_argument(
+        "--mcstats-extra", dest='mcstats_extra',
+        help="comma-separated extra stats groups to poll, e.g. slabs,conns")
+    parser.add_argument(
+        "--threads-period", dest='threads_period', type=float, default=1,
+        help="per-thread scheduling statistics sampling period in seconds (0 disables it)")
+    parser.add_argument(
+        "--threads-process", dest='threads_process', default='memcached',
+        help="process whose threads are profiled")
+    parser.add_argument(
+        "--idle-trace", dest='idle_trace', action='store_true',
+        help="trace every cpu idle state transition through tracefs (requires root)")
+    parser.add_argument(
+        "--ring-seconds", dest='ring_seconds', type=float,
+        help="keep only the last RING_SECONDS of samples per metric in a fixed-size ring buffer")
+    parser.add_argument(
+        "--ring-samples", dest='ring_samples', type=int,
+        help="keep only the last RING_SAMPLES samples per metric in a fixed-size ring buffer")
+    parser.add_argument(
+        "--spill-dir", dest='spill_dir',
+        help="also append every sample to a log in SPILL_DIR that can be reported after a restart with report --from-log")
+    parser.add_argument(
+        "--housekeeping-cpus", dest='housekeeping_cpus',
+        help="cpu list, e.g. 10-11, to which the daemon, its sampler threads and child processes are restricted")
+    parser.add_argument(
+        "--tick-priority", dest='tick_priority', type=int,
+        help="run the tick thread with SCHED_FIFO at this priority (requires root)")
+    parser.add_argument(
+        "--tick-nice", dest='tick_nice', type=int,
+        help="nice value of the tick thread")
     parser.add_argument(
         "-v", "--verbose", dest='verbose', action='store_true',
         help="verbose")
 
     subparsers = parser.add_subparsers(dest='subparser_name', help='sub-command help')
-    actions = [StartAction, StopAction, ReportAction, SetAction]
+    actions = [StartAction, StopAction, ReportAction, OverheadAction, SetAction]
     for a in actions:
       a.add_parser(subparsers)
 
@@ -380,13 +2795,13 @@ def parse_args():
     else:
         logging.getLogger('').setLevel(logging.ERROR)
 
-    if args.hostname:
+    if args.hostname or args.inventory:
         if 'func' in args:
             args.func(args)
         else:
             raise Exception('Attempt to run in client mode but no command is given')
     else:
-        server(args.port)
+        server(args)
 
 def real_main():
     parse_args()
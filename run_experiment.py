@@ -7,8 +7,12 @@ import sys
 import time 
 import os
 import configparser
+import threading
+import json
+import concurrent.futures
 
 import common 
+import profiler
 
 log = logging.getLogger(__name__)
 
@@ -32,6 +36,77 @@ def run_ansible_playbook(inventory, extravars=None, playbook=None, tags=None):
     print(cmd)
     r = os.system(cmd)
 
+class SshPool:
+    """Keeps one SSH connection per host open across experiments and runs commands on them in parallel.
+
+    Every command runs on its own channel of the host's connection, so it costs 
+    neither a new handshake nor an ansible-playbook process.
+    """
+    def __init__(self, username=None):
+        self.username = username
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def connect(self, hostname):
+        import paramiko.client
+        client = paramiko.client.SSHClient()
+        client.set_missing_host_key_policy(paramiko.client.AutoAddPolicy)
+        agent = paramiko.Agent()
+        for key in agent.get_keys():
+            try:
+                client.connect(hostname, username=self.username, pkey=key)
+                return client
+            except Exception as e:
+                logging.error(e)
+        # without a usable agent key, fall back to the keys in ~/.ssh
+        client.connect(hostname, username=self.username)
+        return client
+
+    def client(self, hostname):
+        # connections are reopened after a host reboots
+        with self.lock:
+            client = self.clients.get(hostname)
+        if client is None or not client.get_transport() or not client.get_transport().is_active():
+            client = self.connect(hostname)
+            with self.lock:
+                self.clients[hostname] = client
+        return client
+
+    def exec(self, hostname, command, background=False):
+        if background:
+            # like an ansible task with poll 0, the command is left running
+            command = 'nohup {} > /dev/null 2>&1 &'.format(command)
+        logging.info('{}: {}'.format(hostname, command))
+        stdin, stdout, stderr = self.client(hostname).exec_command(command)
+        # both streams are drained before waiting for the exit status, so that 
+        # a command with a lot of output cannot block on a full channel window
+        errors = []
+        stderr_reader = threading.Thread(target=lambda: errors.append(stderr.read()))
+        stderr_reader.start()
+        lines = stdout.read().decode('utf-8').splitlines()
+        stderr_reader.join()
+        status = stdout.channel.recv_exit_status()
+        if status:
+            for l in errors[0].decode('utf-8').splitlines():
+                logging.info('{}: {}'.format(hostname, l))
+        return lines
+
+    def run(self, commands, background=False):
+        """Runs commands[host] on every host in parallel and returns their output by host"""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(commands)) as executor:
+            futures = {host: executor.submit(self.exec, host, command, background) for (host, command) in commands.items()}
+            return {host: future.result() for (host, future) in futures.items()}
+
+    def close(self):
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients = {}
+
+# runs the profiler and memcached steps over persistent SSH connections when set, 
+# and through the ansible playbooks otherwise
+ssh_pool = None
+
 def run_socwatch(conf,name):
     extravars = [
         'MONITOR_TIME={}'.format("40"),
@@ -72,12 +147,21 @@ def set_core_freq(conf, freq_mhz):
        playbook='ansible/configure_core_freq.yml')
 
 def run_profiler(conf):
+    if ssh_pool:
+        command = 'sudo python3 ~/mcperf/profiler.py --spill-dir /var/tmp/mcperf-profiler'
+        ssh_pool.run({host: command for host in [memcached_node()] + agents_list()}, background=True)
+        return
     run_ansible_playbook(
         inventory='hosts', 
         playbook='ansible/profiler.yml', 
         tags='run_profiler')
 
 def kill_profiler(conf):
+    if ssh_pool:
+        # the bracket keeps pkill from matching the shell running it
+        command = "sudo pkill -f '[m]cperf/profiler.py'"
+        ssh_pool.run({host: command for host in [memcached_node()] + agents_list()})
+        return
     run_ansible_playbook(
         inventory='hosts', 
         playbook='ansible/profiler.yml', 
@@ -88,6 +172,15 @@ def run_remote(conf):
         'WORKER_THREADS={}'.format(conf.memcached_worker_threads), 
         'MEMORY_LIMIT_MB={}'.format(conf.memcached_memory_limit_mb), 
         'PIN_THREADS={}'.format(conf.memcached_pin_threads)]
+    if ssh_pool:
+        commands = {agent: '~/mcperf/memcache-perf/mcperf -T 40 -A' for agent in agents_list()}
+        commands[memcached_node()] = '~/mcperf/memcached/memcached -t {} -m {} -c 32768'.format(conf.memcached_worker_threads, conf.memcached_memory_limit_mb)
+        ssh_pool.run(commands, background=True)
+        if str(conf.memcached_pin_threads).lower() == 'true':
+            # give memcached time to spawn its worker threads before pinning them
+            time.sleep(1)
+            ssh_pool.run({memcached_node(): '~/mcperf/memcached-pt.py {}'.format(conf.memcached_worker_threads)})
+        return
     run_ansible_playbook(
         inventory='hosts', 
         extravars=extravars, 
@@ -99,6 +192,11 @@ def kill_remote(conf):
         'WORKER_THREADS={}'.format(conf.memcached_worker_threads), 
         'MEMORY_LIMIT_MB={}'.format(conf.memcached_memory_limit_mb), 
         'PIN_THREADS={}'.format(conf.memcached_pin_threads)]
+    if ssh_pool:
+        commands = {agent: 'pkill mcperf' for agent in agents_list()}
+        commands[memcached_node()] = 'pkill memcached'
+        ssh_pool.run(commands)
+        return
     run_ansible_playbook(
         inventory='hosts', 
         extravars=extravars, 
@@ -171,31 +269,31 @@ def run_single_experiment(root_results_dir, name_prefix, conf, idx):
         .format(agents_parameter(), conf.mcperf_warmup_qps, conf.mcperf_warmup_time, conf.mcperf_records, conf.mcperf_iadist, conf.mcperf_keysize, conf.mcperf_valuesize))    
 
     # do the measured run
-    exec_command("./profiler.py -n node1 start")
-    run_socwatch(conf,results_dir_name)
+    profiled_nodes = [memcached_node()] + agents_list()
+    profiler_dirs = {node: os.path.join(results_dir_path, node) for node in agents_list()}
+    profiler_dirs[memcached_node()] = memcached_results_dir_path
+    profilers = profiler.ProfilerClients(profiled_nodes)
+    # trace C-state transitions of the server cores in place of a socwatch run
+    profiler.ProfilerClients([memcached_node()]).set([{'name': 'idletrace', 'enabled': True}])
+    profilers.start()
+    # stream profiler samples to the results directory while the run is in progress, 
+    # so that they survive even if the profiler is killed before a final report
+    # run on an executor so that a failure to follow any host is raised once the run ends
+    report_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    report_follower = report_executor.submit(profilers.follow, profiler_dirs, packed=True)
     run_socwatch_io(conf,results_dir_name)
     stdout = exec_command(
         "./memcache-perf/mcperf -s node1 --noload -B -T 40 -Q 1000 -D 4 -C 4 "
         "{} -c 4 -q {} -t {} -r {} "
         "--iadist={} --keysize={} --valuesize={}"
         .format(agents_parameter(), conf.mcperf_qps, conf.mcperf_time, conf.mcperf_records, conf.mcperf_iadist, conf.mcperf_keysize, conf.mcperf_valuesize))
-    exec_command("./profiler.py -n node1 stop")
-
-    #check if socwatch is still processing
-    active_socwatch=exec_command("/users/ganton12/mcperf/scripts/check-socwatch-status.sh node1")
-    while (int(active_socwatch[0]) > 2):
-       time.sleep(30)
-       active_socwatch=exec_command("/users/ganton12/mcperf/scripts/check-socwatch-status.sh node1")
-
-    exec_command("python3 ./profiler.py -n node1 report -d {}".format(memcached_results_dir_path))
-
-    mcperf_results_path_name = os.path.join(results_dir_path, 'mcperf')
-    with open(mcperf_results_path_name, 'w') as fo:
-        for l in stdout:
-            fo.write(l+'\n')
+    profilers.stop()
+    report_executor.shutdown()
+    report_follower.result()
+    with open(os.path.join(results_dir_path, 'profiler-overhead'), 'w') as fo:
+        json.dump(profilers.overhead(), fo, indent=2)
 
     # write statistics 
-    exec_command("./profiler.py -n node1 report -d {}".format(memcached_results_dir_path))
     mcperf_results_path_name = os.path.join(results_dir_path, 'mcperf')
     with open(mcperf_results_path_name, 'w') as fo:
         for l in stdout:
@@ -236,6 +334,13 @@ def run_multiple_experiments(root_results_dir, batch_name, system_conf, batch_co
 
 
 def main(argv):
+    global ssh_pool
+    parser = argparse.ArgumentParser()
+    parser.add_argument("batch_name", help="experiment name")
+    parser.add_argument(
+        "--backend", dest='backend', choices=['ssh', 'ansible'], default='ssh',
+        help="run the profiler and memcached steps over persistent SSH connections or through ansible playbooks")
+    args = parser.parse_args(argv)
     system_confs = [
 ##        {'turbo': True,  'kernelconfig': 'vanilla'},
 ##        {'turbo': False,  'kernelconfig': 'vanilla'},
@@ -268,12 +373,16 @@ def main(argv):
         'mcperf_valuesize': 'fb_value'
     })
     logging.getLogger('').setLevel(logging.INFO)
-    if len(argv) < 1:
-        raise Exception("Experiment name is missing")
-    batch_name = argv[0]
-    for iter in range(0, 3):
-        for system_conf in system_confs:
-            run_multiple_experiments('/users/hvolos01/data', batch_name, system_conf, batch_conf, iter)
+    batch_name = args.batch_name
+    if args.backend == 'ssh':
+        ssh_pool = SshPool()
+    try:
+        for iter in range(0, 3):
+            for system_conf in system_confs:
+                run_multiple_experiments('/users/hvolos01/data', batch_name, system_conf, batch_conf, iter)
+    finally:
+        if ssh_pool:
+            ssh_pool.close()
 
 if __name__ == '__main__':
     main(sys.argv[1:])